@@ -15,7 +15,45 @@ def create_app():
     app.config.from_mapping(
         # Define config variables
         DATABASE=os.path.join(app.instance_path, "database.sqlite"),
+        DB_WRITER_BATCH=64,
         POSE_MODEL="yolo11n-pose.pt",
+        POSE_MODEL_POOL_SIZE=2,
+        POSE_MODEL_PRELOAD=True,
+        # Seconds to wait for a free pose model before the checkout fails
+        POSE_MODEL_TIMEOUT=30,
+        # "torch", or "onnx"/"openvino" to run an export of POSE_MODEL, with
+        # POSE_THREADS intra-op threads per model (None keeps the default)
+        POSE_BACKEND="torch",
+        POSE_THREADS=None,
+        POSE_TRACKER="botsort.yaml",
+        INGEST_FRAME_SIZE=640,
+        INGEST_BATCH_SIZE=16,
+        INGEST_WORKERS=1,
+        INFERENCE_MAX_BATCH=8,
+        INFERENCE_MAX_WAIT_MS=15,
+        INFERENCE_IMGSZ=640,
+        # Crop dance frames to the dancers' last boxes, with a full frame
+        # every ROI_REDETECT_INTERVAL frames
+        ROI_CROP=False,
+        ROI_MARGIN=0.15,
+        ROI_REDETECT_INTERVAL=15,
+        SESSION_IDLE_TIMEOUT=600,
+        STEP_TOLERANCE=0.05,
+        # "beat" grades the frame sent on each beat, "window" grades frames
+        # sampled between beats against an interpolated reference
+        SCORING_MODE="beat",
+        SCORING_WINDOW=0.25,
+        SCORING_SUBDIVISIONS=4,
+        # Per stage timers of the dance pipeline served at /metrics, and of
+        # reference ingestion when METRICS_INGEST_TIMERS is set
+        METRICS_TIMERS=True,
+        METRICS_INGEST_TIMERS=False,
+        TIMELINE_CACHE_BYTES=64 * 1024 * 1024,
+        THUMBNAIL_CACHE_BYTES=32 * 1024 * 1024,
+        FILE_CACHE_BYTES=1024 * 1024,
+        MEDIA_MAX_AGE=7 * 24 * 60 * 60,
+        ANALYSIS_CACHE_FOLDER=os.path.join(app.instance_path, "cache"),
+        ANALYSIS_CACHE_BYTES=2 * 1024 * 1024 * 1024,
         REFERENCES_FOLDER=os.path.join(app.instance_path, "references"),
     )
 
@@ -32,9 +70,11 @@ def create_app():
     socketio.init_app(app)
     assets.init_app(app)
 
-    from flaskr import db, scripts
+    from flaskr import cache, db, metrics, scripts
 
+    cache.init_app(app)
     db.init_app(app)
+    metrics.init_app(app)
     scripts.init_app(app)
 
     controllers = Bundle(
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Tuple
+
+import numpy as np
+from flask import Flask, current_app
+from numpy._typing import NDArray
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value, size: int):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            # Values larger than the whole cache are never kept
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def resize(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    # Entries are .npz files named after a hash of their key. The mtime of an
+    # entry is bumped on every hit, so eviction removes the least recently used
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256("\0".join(str(p) for p in parts).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], key + ".npz")
+
+    def load(self, key: str) -> Dict[str, NDArray] | None:
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, zlib.error):
+            # A truncated or corrupt entry is removed so it is rebuilt next time
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return arrays
+
+    def save(self, key: str, **arrays: NDArray):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written aside and renamed so concurrent readers never see half a file
+        (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        result = []
+        for root, _dirs, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith(".npz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for (_, size, _) in entries)
+
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self.lock:
+                self.evictions += 1
+
+    def clear(self) -> int:
+        entries = self.entries()
+        for _mtime, _size, path in entries:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(entries)
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        with self.lock:
+            return {
+                "folder": self.folder,
+                "entries": len(entries),
+                "bytes": sum(size for (_, size, _) in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+timelines = LRUCache(64 * 1024 * 1024)
+thumbnails = LRUCache(32 * 1024 * 1024)
+files = LRUCache(1024 * 1024)
+
+
+_analysis: DiskCache | None = None
+
+
+def get_analysis_cache() -> DiskCache:
+    global _analysis
+
+    if _analysis is None:
+        _analysis = DiskCache(
+            current_app.config["ANALYSIS_CACHE_FOLDER"],
+            current_app.config["ANALYSIS_CACHE_BYTES"],
+        )
+    return _analysis
+
+
+def invalidate_reference(reference_id: int):
+    timelines.invalidate(reference_id)
+    thumbnails.invalidate(reference_id)
+    files.invalidate(reference_id)
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {
+        "timelines": timelines.stats(),
+        "thumbnails": thumbnails.stats(),
+        "files": files.stats(),
+    }
+
+
+def init_app(app: Flask):
+    timelines.resize(app.config["TIMELINE_CACHE_BYTES"])
+    thumbnails.resize(app.config["THUMBNAIL_CACHE_BYTES"])
+    files.resize(app.config["FILE_CACHE_BYTES"])
@@ -1,127 +1,379 @@
 import base64
-import json
+import time
 
 import cv2
 import numpy as np
-from flask import current_app
+from flask import current_app, request
 from flask_socketio import Namespace, emit
-from ultralytics import YOLO
 
-from flaskr.db import get_db
-from flaskr.videos import get_steps
-from steps.video import grade_poses, normalize_pose
+from flaskr import metrics
+from flaskr.db.leaderboard import record_scores, record_session
+from flaskr.db.writer import get_writer
+from flaskr.frames import decode_frame
+from flaskr.pose import get_pool
+from flaskr.pose.scheduler import InferenceScheduler
+from flaskr.responses import (
+    DROPPED,
+    NOT_SCORED,
+    DanceResult,
+    encode_dance_response,
+    encode_prepare_response,
+)
+from flaskr.sessions import DanceSession, SessionRegistry
+from flaskr.videos import get_timeline
+from steps.video import (
+    grade_pose_array,
+    grade_pose_windows,
+    pose_arrays,
+    shift_result,
+    update_tracker,
+)
 
 
 class DanceNamespace(Namespace):
+    def __init__(self, namespace=None):
+        super().__init__(namespace)
+        self.registry: SessionRegistry | None = None
+        self.scheduler: InferenceScheduler | None = None
+
+    def get_registry(self) -> SessionRegistry:
+        if self.registry is None:
+            self.registry = SessionRegistry(
+                current_app.config["POSE_TRACKER"],
+                current_app.config["SESSION_IDLE_TIMEOUT"],
+                current_app.config["ROI_MARGIN"],
+                current_app.config["ROI_REDETECT_INTERVAL"],
+            )
+            metrics.add_collector(self.registry.metrics)
+        return self.registry
+
+    def get_scheduler(self) -> InferenceScheduler:
+        if self.scheduler is None:
+            self.scheduler = InferenceScheduler(
+                get_pool(),
+                self.socketio.server.eio,
+                current_app.config["INFERENCE_MAX_BATCH"],
+                current_app.config["INFERENCE_MAX_WAIT_MS"] / 1000,
+                current_app.config["INFERENCE_IMGSZ"],
+            )
+            scheduler = self.scheduler
+            metrics.add_collector(
+                lambda: metrics.stats_samples(
+                    "inference",
+                    scheduler.stats(),
+                    counters=("batches", "frames", "dropped"),
+                )
+            )
+        return self.scheduler
+
+    @property
+    def session(self) -> DanceSession | None:
+        return self.get_registry().get(request.sid)
+
     def on_connect(self):
-        model_config = current_app.config["POSE_MODEL"] or "yolo11n-pose.pt"
-        self.model = YOLO(model_config)
+        registry = self.get_registry()
+        for sid in registry.evict_idle():
+            metrics.forget_session(sid)
+            self.disconnect(sid)
+        registry.open(request.sid)
 
     def on_disconnect(self):
-        self.model = None
+        self.get_registry().close(request.sid)
+        metrics.forget_session(request.sid)
 
-    def on_prepare(self, data: str):
-        image_data = base64.b64decode(data)
-        nparr = np.frombuffer(image_data, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    def track(self, session: DanceSession, frame, stale=None, crop=False):
+        # Frames from all sessions are batched together, tracking stays per session
+        frame = self.match_frame_size(session, frame)
+        roi_crop = current_app.config["ROI_CROP"]
+        if crop and roi_crop:
+            (image, offset) = session.roi.crop(frame)
+        else:
+            (image, offset) = (frame, None)
 
-        if self.model is None or frame is None:
-            return
+        with metrics.timer("infer", session.sid):
+            result = self.get_scheduler().infer(image, stale)
+        if result is None:
+            return None
+        with metrics.timer("track", session.sid):
+            if offset is not None:
+                result = shift_result(result, frame, offset)
+            result = update_tracker(session.tracker, result)
+        if not roi_crop:
+            return result
+
+        # The next dance frame is cropped around the registered dancers, or
+        # around everyone while players are still being picked
+        boxes = result.boxes
+        if session.track_slots and boxes.id is not None:
+            ids = boxes.id.cpu().numpy().astype(np.int64)
+            registered = np.isin(ids, list(session.track_slots))
+            xyxy = boxes.xyxy.cpu().numpy()[registered]
+        else:
+            xyxy = boxes.xyxy.cpu().numpy()
+        (height, width) = frame.shape[:2]
+        session.roi.update(xyxy, width, height)
 
-        result = self.model.track(frame, persist=True)[0]
-        emit("prepare_response", result.to_json())
+        return result
 
-    def on_dance(self, data, timestamp):
-        image_data = base64.b64decode(data)
-        nparr = np.frombuffer(image_data, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    def match_frame_size(self, session: DanceSession, frame):
+        # The tracker keeps the previous frame for its motion compensation and
+        # boxes in pixels, so frames the client downscales to keep up are
+        # scaled back to the size the session started with
+        (height, width) = frame.shape[:2]
+        if session.frame_size is None:
+            session.frame_size = (width, height)
+        elif session.frame_size != (width, height):
+            frame = cv2.resize(frame, session.frame_size)
+        return frame
 
-        if self.model is None or frame is None:
+    def on_prepare(self, data: bytes | str):
+        (frame, _timestamp) = decode_frame(data)
+
+        session = self.session
+        if session is None or frame is None:
             return
 
-        result = self.model.track(frame, persist=True)[0]
-        result = json.loads(result.to_json(normalize=True))
+        # The client sends its next prepare frame once answered, so a frame no
+        # pose model was free for is answered with no detections
+        try:
+            result = self.track(session, frame)
+        except TimeoutError:
+            result = None
+        emit("prepare_response", encode_prepare_response(result))
 
-        current_step = None
-        for step in self.steps:
-            if abs(step[0] - timestamp) < 0.001:
-                current_step = step[1]
+    def on_dance(self, data: bytes | str, timestamp: float | None = None):
+        received = time.perf_counter()
+        metrics.count("dance_frames_total")
+        with metrics.timer("decode", request.sid):
+            (frame, frame_timestamp) = decode_frame(data)
+        if timestamp is None:
+            timestamp = frame_timestamp
 
-        if current_step is None:
+        session = self.session
+        if session is None or frame is None or timestamp is None:
+            metrics.count("dance_frames_dropped_total", (("reason", "invalid"),))
             return
 
-        dancers = dict()
-        for dancer in result:
-            id = dancer["track_id"]
-            if not id in self.game_state:
-                continue
+        session.pending += 1
+        session.latest_timestamp = max(session.latest_timestamp, timestamp)
+        try:
+            result = self.score_frame(session, frame, timestamp)
+        finally:
+            session.pending -= 1
 
-            pose = normalize_pose(dancer)
-            score = grade_poses(pose, current_step)
+        # Every frame is answered, so the client can adapt its capture to the
+        # processing latency and queue depth of its session
+        session.update_latency(time.perf_counter() - received)
+        with metrics.timer("response", session.sid):
+            response = encode_dance_response(
+                result, timestamp, session.latency, session.pending
+            )
+        with metrics.timer("emit", session.sid):
+            emit("dance_response", response)
+        if metrics.timers_enabled():
+            elapsed = time.perf_counter() - received
+            metrics.observe_stage("total", session.sid, elapsed)
 
-            [dancer_id, acc_score] = self.game_state[id]
-            acc_score += score
+    def track_dancers(self, session: DanceSession, frame, timestamp: float):
+        # A frame still waiting for inference when a later one arrives is
+        # already behind the music, so it is skipped instead of scored late
+        try:
+            result = self.track(
+                session, frame, lambda: session.latest_timestamp > timestamp, crop=True
+            )
+        except TimeoutError:
+            session.dropped += 1
+            metrics.count("dance_frames_dropped_total", (("reason", "busy"),))
+            return None
+        if result is None:
+            session.dropped += 1
+            metrics.count("dance_frames_dropped_total", (("reason", "stale"),))
+            return None
 
-            self.game_state[id] = [dancer_id, acc_score]
+        with metrics.timer("pose", session.sid):
+            (ids, _xyxyn, poses) = pose_arrays(result)
+            registered = np.isin(ids, list(session.track_slots))
+            return (ids[registered].tolist(), poses[registered].astype(np.float64))
 
-            dancers[id] = {
-                "pose": pose,
-                "score": score,
-                "currentScore": acc_score / len(self.steps),
-            }
+    def score_frame(
+        self, session: DanceSession, frame, timestamp: float
+    ) -> DanceResult:
+        if current_app.config["SCORING_MODE"] == "window":
+            return self.score_window(session, frame, timestamp)
+        return self.score_beat(session, frame, timestamp)
 
-        emit("dance_response", {"step": current_step, "dancers": dancers})
+    def score_beat(self, session: DanceSession, frame, timestamp: float) -> DanceResult:
+        # Several frames can land near one beat, only the first one is scored
+        index = session.timeline.find(timestamp, current_app.config["STEP_TOLERANCE"])
+        if index is None or session.scored[index]:
+            metrics.count("dance_frames_dropped_total", (("reason", "off_beat"),))
+            return DROPPED
 
-        self.frames += 1
+        session.scored[index] = True
+        current_step = session.timeline.poses[index]
 
-    def on_register(self, reference_id, dancers):
-        self.steps = get_steps(reference_id)
-        db = get_db()
-        cursor = db.cursor()
+        tracked = self.track_dancers(session, frame, timestamp)
+        if tracked is None:
+            return DROPPED
+        (track_ids, poses) = tracked
+        slots = [session.track_slots[track_id] for track_id in track_ids]
 
-        cursor.execute(
-            'INSERT INTO "Sessions" (reference_id) VALUES (?)', (reference_id,)
+        # All dancers are graded against the step in a single call, the beat
+        # counts even when none of them is in the frame
+        with metrics.timer("grade", session.sid):
+            scores = grade_pose_array(poses, current_step)
+        session.scores[slots] += scores
+        session.frames += 1
+
+        # The client already holds the steps, so the step goes by its index
+        return DanceResult(
+            False,
+            index,
+            track_ids,
+            poses,
+            scores,
+            session.scores[slots] / len(session.timeline),
         )
-        session_id = cursor.lastrowid
 
-        self.game_state = dict()
-        self.frames = 0
+    def score_window(
+        self, session: DanceSession, frame, timestamp: float
+    ) -> DanceResult:
+        window = current_app.config["SCORING_WINDOW"]
+
+        tracked = self.track_dancers(session, frame, timestamp)
+        if tracked is None:
+            return DROPPED
+        (track_ids, poses) = tracked
+        slots = [session.track_slots[track_id] for track_id in track_ids]
+
+        live = np.zeros((len(session.track_slots), 17, 3), dtype=np.float32)
+        visible = np.zeros(len(session.track_slots), dtype=np.bool_)
+        live[slots] = poses
+        visible[slots] = True
+        session.push_history(timestamp, live, visible, 3 * window)
 
-        def register_dancer(dancer):
-            if dancer[1] is not None:
-                image_data = base64.b64decode(dancer[1])
-                nparr = np.frombuffer(image_data, np.uint8)
-                frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                _, buffer = cv2.imencode(".jpg", frame)
-                avatar = buffer.tobytes()
-            else:
-                avatar = None
+        # A beat is scored once the live window around it is complete
+        with metrics.timer("grade", session.sid):
+            scored = self.score_beats(session, timestamp - window, window)
+        if scored is None:
+            return NOT_SCORED
+        (index, scores, present) = scored
 
+        shown = present[slots]
+        slots = np.asarray(slots, dtype=np.intp)[shown]
+        return DanceResult(
+            False,
+            index,
+            np.asarray(track_ids)[shown].tolist(),
+            poses[shown],
+            scores[slots],
+            session.scores[slots] / len(session.timeline),
+        )
+
+    def score_beats(self, session: DanceSession, until: float, window: float):
+        # Grades the unscored beats up to `until` against the reference
+        # trajectory, so dancers a little early or late still match the step.
+        # Returns the last beat scored with its per slot scores, if any
+        timeline = session.timeline
+        trajectory = timeline.trajectory(current_app.config["SCORING_SUBDIVISIONS"])
+
+        # Beats older than the kept history can no longer be scored
+        first = int(np.searchsorted(timeline.timestamps, until - 2 * window))
+        last = int(np.searchsorted(timeline.timestamps, until, side="right"))
+        ready = first + np.flatnonzero(~session.scored[first:last])
+        session.scored[:last] = True
+
+        scored = None
+        for index in ready:
+            beat = timeline.timestamps[index]
+            live = np.abs(session.history_timestamps - beat) <= window
+            (lo, hi) = np.searchsorted(
+                trajectory.timestamps, [beat - 2 * window, beat + 2 * window]
+            )
+
+            (scores, present) = grade_pose_windows(
+                session.history_timestamps[live],
+                session.history_poses[:, live],
+                session.history_visible[:, live],
+                trajectory.timestamps[lo:hi],
+                trajectory.poses[lo:hi],
+                window,
+            )
+            # Like beat mode, a beat counts once a frame near it was processed,
+            # and dancers nobody saw score 0 on it. Beats no frame made it to
+            # are left out in both modes
+            if not live.any():
+                continue
+
+            session.scores += scores
+            session.frames += 1
+            scored = (int(index), scores, present)
+
+        return scored
+
+    def on_register(self, reference_id, dancers):
+        session = self.session
+        if session is None:
+            return
+
+        timeline = get_timeline(reference_id)
+        session.register(reference_id, timeline, [track_id for track_id, _ in dancers])
+        dancer_ids = session.dancer_ids
+
+        def insert_session(db):
+            cursor = db.cursor()
             cursor.execute(
-                'INSERT INTO "Dancers" (session_id, avatar, score) VALUES (?, ?, ?)',
-                (session_id, avatar, 0),
+                'INSERT INTO "Sessions" (reference_id) VALUES (?)', (reference_id,)
             )
-            dancer_id = cursor.lastrowid
-            self.game_state[dancer[0]] = [dancer_id, 0]
+            session.session_id = cursor.lastrowid
+
+            for slot, (_, avatar) in enumerate(dancers):
+                cursor.execute(
+                    'INSERT INTO "Dancers" (session_id, avatar, score) VALUES (?, ?, ?)',
+                    (session.session_id, encode_avatar(avatar), 0),
+                )
+                dancer_ids[slot] = cursor.lastrowid
 
-        for dancer in dancers:
-            register_dancer(dancer)
+            record_session(db, reference_id, session.session_id)
 
-        db.commit()
+        get_writer().submit(insert_session)
 
     def on_finished(self):
-        db = get_db()
-        cursor = db.cursor()
+        session = self.session
+        if session is None:
+            return
 
-        scores = dict()
-        for k, v in self.game_state.items():
-            print(k, v)
-            final_score = v[1] / self.frames
-            cursor.execute(
-                'UPDATE "Dancers" SET score = ? WHERE dancer_id = ?',
-                (int(min(max(final_score, 0), 100)), v[0]),
+        if current_app.config["SCORING_MODE"] == "window":
+            self.score_beats(
+                session, session.latest_timestamp, current_app.config["SCORING_WINDOW"]
             )
-            scores[k] = final_score
 
-        db.commit()
+        scores = dict()
+        final_scores = dict()
+        for track_id, slot in session.track_slots.items():
+            final_score = session.scores[slot] / max(session.frames, 1)
+            final_scores[slot] = int(min(max(final_score, 0), 100))
+            scores[track_id] = final_score
+
+        # Queued after the register insert, so the dancer ids are known by then
+        reference_id = session.reference_id
+        dancer_ids = session.dancer_ids
+
+        def update_scores(db):
+            rows = [(s, int(dancer_ids[slot])) for slot, s in final_scores.items()]
+            db.executemany('UPDATE "Dancers" SET score = ? WHERE dancer_id = ?', rows)
+            record_scores(db, reference_id, [(d, s) for s, d in rows])
+
+        get_writer().submit(update_scores)
         emit("scores", scores)
+
+
+def encode_avatar(data: str | None) -> bytes | None:
+    if data is None:
+        return None
+
+    image_data = base64.b64decode(data)
+    nparr = np.frombuffer(image_data, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    _, buffer = cv2.imencode(".jpg", frame)
+    return buffer.tobytes()
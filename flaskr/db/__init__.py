@@ -5,6 +5,9 @@ from datetime import datetime
 import click
 from flask import Flask, current_app, g
 
+from flaskr.db.leaderboard import rebuild_leaderboard
+from flaskr.db.migrations import migrate
+
 
 def get_db():
     if "db" not in g:
@@ -42,9 +45,28 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("migrate-db")
+def migrate_db_command():
+    db = get_db()
+    applied = migrate(db)
+    if applied:
+        db.execute("VACUUM")
+    click.echo(f"Applied {applied} migration(s).")
+
+
+@click.command("rebuild-leaderboard")
+def rebuild_leaderboard_command():
+    db = get_db()
+    count = rebuild_leaderboard(db)
+    db.commit()
+    click.echo(f"Rebuilt the leaderboard for {count} reference(s).")
+
+
 sqlite3.register_converter("timestamp", lambda v: datetime.fromisoformat(v.decode()))
 
 
 def init_app(app: Flask):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(rebuild_leaderboard_command)
@@ -0,0 +1,88 @@
+import sqlite3
+from typing import Iterable, List, Tuple
+
+# Home page listing, reads one leaderboard row per reference instead of
+# aggregating every session and dancer on each request
+REFERENCES_QUERY = """
+SELECT
+    r.reference_id,
+    r.title,
+    COALESCE(l.best_score, 0) AS highest_score,
+    l.best_dancer_id AS highest_scorer_id
+FROM "References" r
+LEFT JOIN "Leaderboard" l ON r.reference_id = l.reference_id
+"""
+
+
+def get_references(db: sqlite3.Connection, sort: str | None) -> List[sqlite3.Row]:
+    if sort == "recent":
+        query = REFERENCES_QUERY + "ORDER BY l.last_session_id DESC"
+    elif sort == "collection":
+        query = REFERENCES_QUERY + "WHERE r.selected = 1 ORDER BY r.reference_id"
+    else:
+        query = REFERENCES_QUERY + "ORDER BY r.reference_id"
+    return db.execute(query).fetchall()
+
+
+def record_session(db: sqlite3.Connection, reference_id: int, session_id: int):
+    db.execute(
+        """
+        INSERT INTO "Leaderboard" (reference_id, best_score, last_session_id)
+        VALUES (?, 0, ?)
+        ON CONFLICT (reference_id) DO UPDATE
+        SET last_session_id = MAX(COALESCE(last_session_id, 0), excluded.last_session_id)
+        """,
+        (reference_id, session_id),
+    )
+
+
+def record_scores(
+    db: sqlite3.Connection, reference_id: int, scores: Iterable[Tuple[int, int]]
+):
+    # scores holds (dancer_id, score) pairs of a finished session
+    best = max(scores, key=lambda s: s[1], default=None)
+    if best is None:
+        return
+
+    dancer_id, score = best
+    db.execute(
+        """
+        INSERT INTO "Leaderboard" (reference_id, best_score, best_dancer_id)
+        VALUES (?, ?, ?)
+        ON CONFLICT (reference_id) DO UPDATE
+        SET best_score = excluded.best_score, best_dancer_id = excluded.best_dancer_id
+        WHERE excluded.best_score > best_score OR best_dancer_id IS NULL
+        """,
+        (reference_id, score, dancer_id),
+    )
+
+
+def rebuild_leaderboard(db: sqlite3.Connection) -> int:
+    db.execute('DELETE FROM "Leaderboard"')
+    cursor = db.execute(
+        """
+        INSERT INTO "Leaderboard"
+            (reference_id, best_score, best_dancer_id, last_session_id)
+        SELECT
+            b.reference_id,
+            COALESCE((SELECT score FROM Dancers WHERE dancer_id = b.best_dancer_id), 0),
+            b.best_dancer_id,
+            b.last_session_id
+        FROM (
+            SELECT
+                s.reference_id,
+                MAX(s.session_id) AS last_session_id,
+                (
+                    SELECT d.dancer_id
+                    FROM Sessions s2
+                    JOIN Dancers d ON s2.session_id = d.session_id
+                    WHERE s2.reference_id = s.reference_id
+                    ORDER BY d.score DESC, d.dancer_id ASC
+                    LIMIT 1
+                ) AS best_dancer_id
+            FROM Sessions s
+            GROUP BY s.reference_id
+        ) b
+        """
+    )
+    return cursor.rowcount
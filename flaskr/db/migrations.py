@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from flaskr.db.leaderboard import rebuild_leaderboard
+
+
+def steps_to_timelines(db: sqlite3.Connection):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "Timelines" (
+          "reference_id" INTEGER PRIMARY KEY,
+          "timestamps" BLOB NOT NULL,
+          "poses" BLOB NOT NULL,
+          FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id")
+        )
+        """
+    )
+
+    has_steps = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Steps'"
+    ).fetchone()
+    if has_steps is None:
+        return
+
+    reference_ids = [
+        r[0] for r in db.execute("SELECT DISTINCT reference_id FROM Steps")
+    ]
+    for reference_id in reference_ids:
+        rows = db.execute(
+            "SELECT timestamp, pose FROM Steps WHERE reference_id = ? ORDER BY timestamp ASC",
+            (reference_id,),
+        ).fetchall()
+        timestamps = np.array([r[0] for r in rows], dtype="<f8")
+        poses = np.array([json.loads(r[1]) for r in rows], dtype="<f4")
+        db.execute(
+            'INSERT OR REPLACE INTO "Timelines" (reference_id, timestamps, poses) VALUES (?, ?, ?)',
+            (reference_id, timestamps.tobytes(), poses.tobytes()),
+        )
+
+    db.execute('DROP TABLE "Steps"')
+
+
+def add_jobs(db: sqlite3.Connection):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "Jobs" (
+          "job_id" INTEGER PRIMARY KEY AUTOINCREMENT,
+          "filepath" TEXT NOT NULL,
+          "filename" TEXT NOT NULL,
+          "selected" BOOLEAN NOT NULL,
+          "status" TEXT NOT NULL,
+          "stage" TEXT,
+          "progress" REAL NOT NULL DEFAULT 0,
+          "reference_id" INTEGER,
+          "error" TEXT,
+          "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          "updated_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id")
+        )
+        """
+    )
+
+
+def add_content_hash(db: sqlite3.Connection):
+    db.execute('ALTER TABLE "References" ADD COLUMN "content_hash" TEXT')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS "References_content_hash" ON "References" ("content_hash")'
+    )
+
+    references = db.execute('SELECT reference_id, filepath FROM "References"')
+    for reference_id, filepath in references.fetchall():
+        if not os.path.exists(filepath):
+            continue
+
+        digest = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            while chunk := file.read(1024 * 1024):
+                digest.update(chunk)
+        db.execute(
+            'UPDATE "References" SET content_hash = ? WHERE reference_id = ?',
+            (digest.hexdigest(), reference_id),
+        )
+
+
+def add_leaderboard(db: sqlite3.Connection):
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS "Sessions_reference_id" ON "Sessions" ("reference_id")'
+    )
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS "Dancers_session_id" ON "Dancers" ("session_id")'
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "Leaderboard" (
+          "reference_id" INTEGER PRIMARY KEY,
+          "best_score" INTEGER NOT NULL DEFAULT 0,
+          "best_dancer_id" INTEGER,
+          "last_session_id" INTEGER,
+          FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id"),
+          FOREIGN KEY ("best_dancer_id") REFERENCES "Dancers" ("dancer_id")
+        )
+        """
+    )
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS "Leaderboard_last_session_id" ON "Leaderboard" ("last_session_id")'
+    )
+    rebuild_leaderboard(db)
+
+
+# MIGRATIONS[i] upgrades a database from user_version i to i + 1
+MIGRATIONS = [
+    steps_to_timelines,
+    add_jobs,
+    add_content_hash,
+    add_leaderboard,
+]
+
+
+def migrate(db: sqlite3.Connection) -> int:
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+
+    for i in range(version, len(MIGRATIONS)):
+        MIGRATIONS[i](db)
+        db.execute(f"PRAGMA user_version = {i + 1}")
+        db.commit()
+
+    return len(MIGRATIONS) - version
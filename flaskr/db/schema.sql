@@ -3,14 +3,18 @@ CREATE TABLE "References" (
   "thumbnail" BLOB,
   "filepath" TEXT NOT NULL,
   "title" INTEGER NOT NULL,
-  "selected" BOOLEAN NOT NULL
+  "selected" BOOLEAN NOT NULL,
+  "content_hash" TEXT
 );
 
-CREATE TABLE "Steps" (
-  "step_id" INTEGER PRIMARY KEY AUTOINCREMENT,
-  "reference_id" INTEGER NOT NULL,
-  "timestamp" REAL NOT NULL,
-  "pose" TEXT NOT NULL,
+CREATE INDEX "References_content_hash" ON "References" ("content_hash");
+
+-- One row per reference, "timestamps" holds float64 beat times and "poses"
+-- the matching float32 (steps x 17 x 3) keypoints, both little endian
+CREATE TABLE "Timelines" (
+  "reference_id" INTEGER PRIMARY KEY,
+  "timestamps" BLOB NOT NULL,
+  "poses" BLOB NOT NULL,
   FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id")
 );
 
@@ -20,6 +24,8 @@ CREATE TABLE "Sessions" (
   FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id")
 );
 
+CREATE INDEX "Sessions_reference_id" ON "Sessions" ("reference_id");
+
 CREATE TABLE "Dancers" (
   "dancer_id" INTEGER PRIMARY KEY AUTOINCREMENT,
   "session_id" INTEGER NOT NULL,
@@ -28,5 +34,39 @@ CREATE TABLE "Dancers" (
   FOREIGN KEY ("session_id") REFERENCES "Sessions" ("session_id")
 );
 
+CREATE INDEX "Dancers_session_id" ON "Dancers" ("session_id");
+
+-- Best score and latest session per reference, maintained by the game as
+-- sessions finish, see db/leaderboard.py
+CREATE TABLE "Leaderboard" (
+  "reference_id" INTEGER PRIMARY KEY,
+  "best_score" INTEGER NOT NULL DEFAULT 0,
+  "best_dancer_id" INTEGER,
+  "last_session_id" INTEGER,
+  FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id"),
+  FOREIGN KEY ("best_dancer_id") REFERENCES "Dancers" ("dancer_id")
+);
+
+CREATE INDEX "Leaderboard_last_session_id" ON "Leaderboard" ("last_session_id");
+
+-- Background ingestion of uploaded references, see videos/jobs.py
+CREATE TABLE "Jobs" (
+  "job_id" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "filepath" TEXT NOT NULL,
+  "filename" TEXT NOT NULL,
+  "selected" BOOLEAN NOT NULL,
+  "status" TEXT NOT NULL,
+  "stage" TEXT,
+  "progress" REAL NOT NULL DEFAULT 0,
+  "reference_id" INTEGER,
+  "error" TEXT,
+  "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  "updated_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY ("reference_id") REFERENCES "References" ("reference_id")
+);
+
 -- Enable foreign key constraints
 PRAGMA foreign_keys = ON;
+
+-- Bump together with MIGRATIONS in db/migrations.py
+PRAGMA user_version = 4;
@@ -0,0 +1,135 @@
+import atexit
+import sqlite3
+import threading
+import time
+import traceback
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, List, Tuple
+
+from flask import current_app
+
+Operation = Callable[[sqlite3.Connection], None]
+
+# Upper bounds in seconds of the write latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class DBWriter:
+    # Owns one WAL-mode connection on a background thread. Realtime handlers
+    # queue operations instead of waiting on the disk, and every drained batch
+    # of operations shares a single commit
+    def __init__(self, database: str, batch_size=64):
+        self.database = database
+        self.batch_size = batch_size
+        self.queue: Queue[Tuple[Operation | None, float]] = Queue()
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.lock = threading.Lock()
+
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+        self.writes = 0
+        self.commits = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, operation: Operation):
+        self.queue.put((operation, time.perf_counter()))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put((None, time.perf_counter()))
+            self.thread.join()
+
+    def run(self):
+        db = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("PRAGMA foreign_keys = ON")
+
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            # The savepoints nest in one transaction, an outermost savepoint
+            # would commit on its own release
+            db.execute("BEGIN")
+            for operation, _queued_at in batch:
+                if operation is None:
+                    running = False
+                    continue
+                # A failing operation is rolled back without losing the rest
+                db.execute("SAVEPOINT operation")
+                try:
+                    operation(db)
+                    db.execute("RELEASE operation")
+                except Exception:
+                    traceback.print_exc()
+                    db.execute("ROLLBACK TO operation")
+                    db.execute("RELEASE operation")
+                    with self.lock:
+                        self.errors += 1
+
+            db.commit()
+            self.record(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+        db.close()
+
+    def record(self, batch: List[Tuple[Operation | None, float]]):
+        now = time.perf_counter()
+        with self.lock:
+            self.commits += 1
+            for operation, queued_at in batch:
+                if operation is None:
+                    continue
+                latency = now - queued_at
+                self.writes += 1
+                self.latency_total += latency
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        self.bucket_counts[i] += 1
+                        break
+                else:
+                    self.bucket_counts[-1] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "pending": self.queue.qsize(),
+                "writes": self.writes,
+                "commits": self.commits,
+                "errors": self.errors,
+                "latency_total": self.latency_total,
+                "latency_buckets": dict(
+                    zip([*map(str, LATENCY_BUCKETS), "+Inf"], self.bucket_counts)
+                ),
+            }
+
+
+_writer: DBWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> DBWriter:
+    global _writer
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = DBWriter(
+                current_app.config["DATABASE"], current_app.config["DB_WRITER_BATCH"]
+            )
+            _writer.start()
+        return _writer
@@ -0,0 +1,105 @@
+import base64
+import struct
+import threading
+import time
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+# magic, version, format, width, height, timestamp (see encodeFrame in util.js)
+HEADER = struct.Struct("<4sBBHHd")
+MAGIC = b"DTBF"
+VERSION = 1
+
+FORMAT_JPEG = 0
+FORMAT_BGR = 1
+FORMAT_GRAY = 2
+
+FORMAT_NAMES = {
+    FORMAT_JPEG: "jpeg",
+    FORMAT_BGR: "bgr",
+    FORMAT_GRAY: "gray",
+}
+
+_stats: Dict[str, Dict[str, float]] = dict()
+_stats_lock = threading.Lock()
+
+
+def _record(transport: str, size: int, elapsed: float):
+    with _stats_lock:
+        stats = _stats.setdefault(transport, {"frames": 0, "bytes": 0, "time": 0.0})
+        stats["frames"] += 1
+        stats["bytes"] += size
+        stats["time"] += elapsed
+
+
+def frame_stats() -> Dict[str, Dict[str, float]]:
+    with _stats_lock:
+        return {
+            transport: {
+                "frames": s["frames"],
+                "bytes_per_frame": s["bytes"] / s["frames"],
+                "decode_time_avg": s["time"] / s["frames"],
+            }
+            for transport, s in _stats.items()
+        }
+
+
+def encode_frame(image: MatLike, format=FORMAT_JPEG, timestamp=0.0, quality=92):
+    height, width = image.shape[:2]
+    header = HEADER.pack(MAGIC, VERSION, format, width, height, timestamp)
+
+    if format == FORMAT_JPEG:
+        _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        payload = buffer.tobytes()
+    elif format == FORMAT_GRAY:
+        payload = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).tobytes()
+    else:
+        payload = np.ascontiguousarray(image).tobytes()
+
+    return header + payload
+
+
+def decode_data_url(data: str) -> MatLike | None:
+    start = time.perf_counter()
+
+    _, _, encoded = data.rpartition("base64,")
+    image_data = base64.b64decode(encoded)
+    nparr = np.frombuffer(image_data, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+    _record("data-url", len(data), time.perf_counter() - start)
+    return frame
+
+
+def decode_binary(data: bytes) -> Tuple[MatLike | None, float | None]:
+    start = time.perf_counter()
+
+    if len(data) < HEADER.size:
+        return (None, None)
+
+    (magic, version, format, width, height, timestamp) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return (None, None)
+
+    # Views into the received message, raw formats are never copied
+    payload = np.frombuffer(data, np.uint8, offset=HEADER.size)
+    if format == FORMAT_JPEG:
+        frame = cv2.imdecode(payload, cv2.IMREAD_COLOR)
+    elif format == FORMAT_BGR and payload.size == width * height * 3:
+        frame = payload.reshape(height, width, 3)
+    elif format == FORMAT_GRAY and payload.size == width * height:
+        frame = cv2.cvtColor(payload.reshape(height, width), cv2.COLOR_GRAY2BGR)
+    else:
+        return (None, None)
+
+    _record(FORMAT_NAMES[format], len(data), time.perf_counter() - start)
+    return (frame, timestamp)
+
+
+def decode_frame(data: bytes | str) -> Tuple[MatLike | None, float | None]:
+    if isinstance(data, str):
+        return (decode_data_url(data), None)
+    return decode_binary(data)
@@ -0,0 +1,248 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from flask import Flask
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+# Upper bounds in seconds of the stage timer histogram buckets
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    10.0,
+    60.0,
+)
+
+STAGE_METRIC = "dance_stage_seconds"
+SESSION_STAGE_METRIC = "dance_session_stage_seconds"
+INGEST_METRIC = "ingest_stage_seconds"
+
+HELP = {
+    STAGE_METRIC: "Time spent in each stage of the dance pipeline",
+    SESSION_STAGE_METRIC: "Time spent in each stage of the dance pipeline by session",
+    INGEST_METRIC: "Time spent in each stage of reference ingestion",
+}
+
+# Disabled timers hand out this shared no-op context manager
+NULL_TIMER = nullcontext()
+
+
+class Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+
+
+class Timer:
+    __slots__ = ("stage", "sid", "start")
+
+    def __init__(self, stage: str, sid: str | None):
+        self.stage = stage
+        self.sid = sid
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        observe_stage(self.stage, self.sid, time.perf_counter() - self.start)
+
+
+class IngestTimer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        observe_ingest({self.stage: time.perf_counter() - self.start})
+
+
+_timers = False
+_ingest_timers = False
+
+_histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+_counters: Dict[Tuple[str, Labels], float] = dict()
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+_lock = threading.Lock()
+
+
+def observe(name: str, labels: Labels, value: float):
+    with _lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = _histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+
+def observe_stage(stage: str, sid: str | None, elapsed: float):
+    observe(STAGE_METRIC, (("stage", stage),), elapsed)
+    if sid is not None:
+        observe(SESSION_STAGE_METRIC, (("session", sid), ("stage", stage)), elapsed)
+
+
+def observe_ingest(timings: Dict[str, float]):
+    if not _ingest_timers:
+        return
+    for stage, elapsed in timings.items():
+        observe(INGEST_METRIC, (("stage", stage),), elapsed)
+
+
+def timers_enabled() -> bool:
+    return _timers
+
+
+def timer(stage: str, sid: str | None = None) -> Timer | nullcontext:
+    # Times a stage of the dance pipeline, overall and for session `sid`
+    if not _timers:
+        return NULL_TIMER
+    return Timer(stage, sid)
+
+
+def ingest_timer(stage: str) -> IngestTimer | nullcontext:
+    if not _ingest_timers:
+        return NULL_TIMER
+    return IngestTimer(stage)
+
+
+def count(name: str, labels: Labels = (), amount=1.0):
+    with _lock:
+        _counters[(name, labels)] = _counters.get((name, labels), 0.0) + amount
+
+
+def forget_session(sid: str):
+    # Session series end with the session, the overall ones keep its samples
+    session = ("session", sid)
+    with _lock:
+        for key in [k for k in _histograms if session in k[1]]:
+            del _histograms[key]
+
+
+def add_collector(collector: Callable[[], Iterable[Sample]]):
+    # Collectors are read on every scrape, for gauges kept elsewhere
+    with _lock:
+        _collectors.append(collector)
+
+
+def stats_samples(
+    prefix: str,
+    stats: Dict[str, Any],
+    labels: Labels = (),
+    counters: Iterable[str] = (),
+):
+    # Numeric entries of a stats() dict named prefix_key. The keys in
+    # `counters` only ever grow and get the _total suffix of a counter
+    counters = set(counters)
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = f"{prefix}_{key}"
+            if key in counters and not name.endswith("_total"):
+                name += "_total"
+            yield (name, labels, float(value))
+
+
+def drain() -> List[Tuple[str, Labels, List[int], float]]:
+    # Takes the histograms recorded in this process, so ingestion workers can
+    # hand their samples back to the web server with the job result
+    with _lock:
+        samples = [(n, k, h.counts, h.total) for (n, k), h in _histograms.items()]
+        _histograms.clear()
+    return samples
+
+
+def merge(samples: List[Tuple[str, Labels, List[int], float]]):
+    with _lock:
+        for name, labels, counts, total in samples:
+            histogram = _histograms.get((name, labels))
+            if histogram is None:
+                histogram = _histograms[(name, labels)] = Histogram()
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.total += total
+
+
+def format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render(samples: Iterable[Sample] = ()) -> str:
+    # Prometheus text exposition format. `samples` and the collected ones are
+    # counters when named *_total, running totals only, and gauges otherwise
+    with _lock:
+        histograms = sorted(
+            (key, list(h.counts), h.total) for key, h in _histograms.items()
+        )
+        counters = sorted(_counters.items())
+        collectors = list(_collectors)
+
+    lines = []
+    described = set()
+
+    def describe(name: str, kind: str):
+        if name not in described:
+            described.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), counts, total in histograms:
+        describe(name, "histogram")
+        cumulative = 0
+        for bound, bucket in zip([*map(str, BUCKETS), "+Inf"], counts):
+            cumulative += bucket
+            le = format_labels(labels, (("le", bound),))
+            lines.append(f"{name}_bucket{le} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+    for (name, labels), value in counters:
+        describe(name, "counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    collected = sorted(
+        [*samples, *(s for collector in collectors for s in collector())]
+    )
+    for name, labels, value in collected:
+        describe(name, "counter" if name.endswith("_total") else "gauge")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app: Flask):
+    global _timers, _ingest_timers
+
+    _timers = app.config["METRICS_TIMERS"]
+    _ingest_timers = app.config["METRICS_INGEST_TIMERS"]
@@ -0,0 +1,139 @@
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, Queue
+from typing import TYPE_CHECKING, Dict, Generator, List
+
+from flask import Flask, current_app
+
+from flaskr.pose.backends import load_model
+
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+
+
+class ModelPool:
+    def __init__(
+        self,
+        model_config: str,
+        size: int = 1,
+        backend="torch",
+        threads: int | None = None,
+        imgsz=640,
+        timeout: float | None = None,
+    ):
+        self.model_config = model_config
+        self.size = max(size, 1)
+        self.backend = backend
+        self.threads = threads
+        self.imgsz = imgsz
+        self.timeout = timeout
+        self.models: Queue["YOLO"] = Queue()
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+        self.load_times: List[float] = []
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def load(self):
+        while True:
+            with self.lock:
+                if self.loaded >= self.size:
+                    return
+                self.loaded += 1
+            self.models.put(self._load_model())
+
+    def _load_model(self) -> "YOLO":
+        start = time.perf_counter()
+        model = load_model(self.model_config, self.backend, self.threads, self.imgsz)
+        elapsed = time.perf_counter() - start
+
+        self.load_times.append(elapsed)
+        print(
+            f"Loaded pose model {self.model_config} ({self.backend}) in {elapsed:.2f}s"
+        )
+        return model
+
+    def acquire(self) -> "YOLO":
+        start = time.perf_counter()
+
+        with self.lock:
+            create = self.models.empty() and self.loaded < self.size
+            if create:
+                self.loaded += 1
+
+        if create:
+            model = self._load_model()
+        else:
+            # A model that never comes back fails later checkouts instead of
+            # blocking them, and the server, for good
+            try:
+                model = self.models.get(timeout=self.timeout)
+            except Empty:
+                with self.lock:
+                    self.timeouts += 1
+                raise TimeoutError(f"No pose model free after {self.timeout}s")
+
+        wait = time.perf_counter() - start
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+        return model
+
+    def release(self, model: "YOLO"):
+        self.models.put(model)
+
+    @contextmanager
+    def checkout(self) -> Generator["YOLO", None, None]:
+        model = self.acquire()
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "size": self.size,
+                "loaded": self.loaded,
+                "available": self.models.qsize(),
+                "load_time_total": sum(self.load_times),
+                "load_time_max": max(self.load_times, default=0.0),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_total,
+                "wait_time_max": self.wait_max,
+                "wait_time_avg": (
+                    self.wait_total / self.checkouts if self.checkouts else 0.0
+                ),
+            }
+
+
+_pool: ModelPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ModelPool:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ModelPool(
+                current_app.config["POSE_MODEL"] or "yolo11n-pose.pt",
+                current_app.config["POSE_MODEL_POOL_SIZE"],
+                current_app.config["POSE_BACKEND"],
+                current_app.config["POSE_THREADS"],
+                current_app.config["INFERENCE_IMGSZ"],
+                current_app.config["POSE_MODEL_TIMEOUT"],
+            )
+        return _pool
+
+
+def preload(app: Flask):
+    with app.app_context():
+        get_pool().load()
@@ -0,0 +1,93 @@
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+
+# "torch" runs the weights eagerly, the others run an export of them loaded
+# through the same ultralytics predictor, so results are interchangeable
+BACKENDS = ("torch", "onnx", "openvino")
+
+WARMUP_FRAME_SIZE = (640, 640, 3)
+
+
+def exported_path(weights: str, backend: str) -> str:
+    # Where ultralytics writes the export of `weights` for `backend`
+    path = Path(weights)
+    if backend == "onnx":
+        return str(path.with_suffix(".onnx"))
+    if backend == "openvino" and not path.name.endswith("_openvino_model"):
+        return str(path.with_name(f"{path.stem}_openvino_model"))
+    return weights
+
+
+def export_model(weights: str, backend: str, imgsz=640, force=False) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown pose backend {backend}, expected one of {BACKENDS}")
+
+    path = exported_path(weights, backend)
+    if backend == "torch" or (os.path.exists(path) and not force):
+        return path
+
+    from ultralytics import YOLO
+
+    # Dynamic axes so the scheduler can batch frames of any size
+    print(f"Exporting pose model {weights} for {backend}")
+    return YOLO(weights).export(format=backend, imgsz=imgsz, dynamic=True)
+
+
+def load_model(
+    weights: str, backend="torch", threads: int | None = None, imgsz=640
+) -> "YOLO":
+    from ultralytics import YOLO
+
+    if backend == "torch" and threads is not None:
+        import torch
+
+        torch.set_num_threads(threads)
+
+    model = YOLO(export_model(weights, backend, imgsz), task="pose")
+    # The warmup also creates the predictor and its runtime session
+    model.predict(np.zeros(WARMUP_FRAME_SIZE, dtype=np.uint8), verbose=False)
+
+    if backend != "torch" and threads is not None:
+        set_runtime_threads(model, backend, threads)
+    return model
+
+
+def set_runtime_threads(model: "YOLO", backend: str, threads: int):
+    # ultralytics creates the ONNX Runtime session and OpenVINO compiled model
+    # without thread settings, so they are rebuilt on the loaded predictor
+    runtime = model.predictor.model
+    path = Path(runtime.w)
+
+    if backend == "onnx":
+        import onnxruntime
+
+        if not runtime.dynamic:
+            print("Static ONNX models keep the default thread count")
+            return
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        runtime.session = onnxruntime.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+    elif backend == "openvino":
+        import openvino as ov
+
+        core = ov.Core()
+        ov_model = core.read_model(model=str(path), weights=path.with_suffix(".bin"))
+        if ov_model.get_parameters()[0].get_layout().empty:
+            ov_model.get_parameters()[0].set_layout(ov.Layout("NCHW"))
+        runtime.ov_compiled_model = core.compile_model(
+            ov_model,
+            device_name="CPU",
+            config={
+                "PERFORMANCE_HINT": runtime.inference_mode,
+                "INFERENCE_NUM_THREADS": threads,
+            },
+        )
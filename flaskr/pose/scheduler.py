@@ -0,0 +1,139 @@
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List
+
+from cv2.typing import MatLike
+
+from flaskr import metrics
+from flaskr.pose import ModelPool
+
+if TYPE_CHECKING:
+    from ultralytics.engine.model import Results
+
+
+class InferenceRequest:
+    __slots__ = ("frame", "event", "stale", "queued_at", "result", "error")
+
+    def __init__(self, frame: MatLike, event, stale: Callable[[], bool] | None):
+        self.frame = frame
+        self.event = event
+        self.stale = stale
+        self.queued_at = time.perf_counter()
+        self.result: "Results | None" = None
+        self.error: Exception | None = None
+
+
+class InferenceScheduler:
+    # `server` is the engine.io server, whose queues and events work with
+    # whichever async mode Socket.IO is running in
+    def __init__(self, pool: ModelPool, server, max_batch=8, max_wait=0.015, imgsz=640):
+        self.pool = pool
+        self.server = server
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self.imgsz = imgsz
+
+        self.queue = server.create_queue()
+        self.empty = server.get_queue_empty_exception()
+        self.started = False
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.frames = 0
+        self.dropped = 0
+        self.batch_size_max = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        # One batch loop per pooled model, so every loaded model serves live
+        # frames and a loop always finds its model free
+        for _ in range(self.pool.size):
+            self.server.start_background_task(self.run)
+
+    def infer(
+        self, frame: MatLike, stale: Callable[[], bool] | None = None
+    ) -> "Results | None":
+        # Returns None when `stale` says the frame is no longer worth running
+        # by the time its batch is picked up
+        self.start()
+
+        request = InferenceRequest(frame, self.server.create_event(), stale)
+        self.queue.put(request)
+        request.event.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except self.empty:
+                    break
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch: List[InferenceRequest]):
+        dropped = [r for r in batch if r.stale is not None and r.stale()]
+        if dropped:
+            with self.lock:
+                self.dropped += len(dropped)
+            for request in dropped:
+                request.event.set()
+            batch = [r for r in batch if r not in dropped]
+            if not batch:
+                return
+
+        started = time.perf_counter()
+        try:
+            with self.pool.checkout() as model, metrics.timer("predict"):
+                results = model.predict(
+                    [r.frame for r in batch], imgsz=self.imgsz, verbose=False
+                )
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+
+        with self.lock:
+            self.batches += 1
+            self.frames += len(batch)
+            self.batch_size_max = max(self.batch_size_max, len(batch))
+            for request in batch:
+                queue_time = started - request.queued_at
+                self.queue_time_total += queue_time
+                self.queue_time_max = max(self.queue_time_max, queue_time)
+
+        for request in batch:
+            request.event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait": self.max_wait,
+                "imgsz": self.imgsz,
+                "batches": self.batches,
+                "frames": self.frames,
+                "dropped": self.dropped,
+                "batch_size_avg": self.frames / self.batches if self.batches else 0.0,
+                "batch_size_max": self.batch_size_max,
+                "queue_time_avg": (
+                    self.queue_time_total / self.frames if self.frames else 0.0
+                ),
+                "queue_time_max": self.queue_time_max,
+            }
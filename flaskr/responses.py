@@ -0,0 +1,180 @@
+import struct
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Sequence
+
+import numpy as np
+from numpy._typing import NDArray
+
+if TYPE_CHECKING:
+    from ultralytics.engine.results import Results
+
+# Binary socket responses, mirrored by decodeDanceResponse and
+# decodePrepareResponse in util.js. Arrays follow the header in order of
+# decreasing alignment, so the client can view them without copying
+
+# magic, version, flags, dancers, queue, step index, timestamp, latency
+DANCE_HEADER = struct.Struct("<4sBBHH2xidf4x")
+DANCE_MAGIC = b"DTBR"
+# magic, version, detections
+PREPARE_HEADER = struct.Struct("<4sBxH")
+PREPARE_MAGIC = b"DTBP"
+VERSION = 1
+
+FLAG_DROPPED = 1
+
+# Normalized keypoint coordinates are sent as int16 fixed point in
+# 1/8192ths, which keeps +-4 pose heights, and confidences as uint8
+COORDINATE_SCALE = 8192
+CONFIDENCE_SCALE = 255
+
+
+class DanceResult(NamedTuple):
+    dropped: bool
+    step: int = -1
+    track_ids: Sequence[int] = ()
+    poses: NDArray = np.zeros((0, 17, 3), dtype=np.float32)
+    scores: NDArray = np.zeros(0, dtype=np.float32)
+    current_scores: NDArray = np.zeros(0, dtype=np.float32)
+
+
+DROPPED = DanceResult(True)
+NOT_SCORED = DanceResult(False)
+
+
+def quantize_poses(poses: NDArray) -> bytes:
+    # (n, 17, 3) poses of (confidence, x, y) as int16 x, y then uint8 confidences
+    coordinates = np.clip(
+        np.rint(poses[..., 1:] * COORDINATE_SCALE), -32768, 32767
+    ).astype("<i2")
+    confidences = np.rint(np.clip(poses[..., 0], 0, 1) * CONFIDENCE_SCALE)
+    return coordinates.tobytes() + confidences.astype(np.uint8).tobytes()
+
+
+def dequantize_poses(data: bytes, count: int, offset=0) -> NDArray:
+    coordinates = np.frombuffer(data, "<i2", count * 17 * 2, offset)
+    confidences = np.frombuffer(data, np.uint8, count * 17, offset + count * 68)
+
+    poses = np.empty((count, 17, 3), dtype=np.float32)
+    poses[..., 0] = confidences.reshape(count, 17) / CONFIDENCE_SCALE
+    poses[..., 1:] = coordinates.reshape(count, 17, 2) / COORDINATE_SCALE
+    return poses
+
+
+def encode_dance_response(
+    result: DanceResult, timestamp: float, latency: float, queue: int
+) -> bytes:
+    count = len(result.track_ids)
+    header = DANCE_HEADER.pack(
+        DANCE_MAGIC,
+        VERSION,
+        FLAG_DROPPED if result.dropped else 0,
+        count,
+        min(queue, 0xFFFF),
+        result.step,
+        timestamp,
+        latency,
+    )
+    if count == 0:
+        return header
+
+    return b"".join(
+        [
+            header,
+            np.asarray(result.track_ids, dtype="<i4").tobytes(),
+            np.asarray(result.scores, dtype="<f4").tobytes(),
+            np.asarray(result.current_scores, dtype="<f4").tobytes(),
+            quantize_poses(result.poses),
+        ]
+    )
+
+
+def decode_dance_response(data: bytes) -> Dict[str, Any]:
+    (magic, version, flags, count, queue, step, timestamp, latency) = (
+        DANCE_HEADER.unpack_from(data)
+    )
+    if magic != DANCE_MAGIC or version != VERSION:
+        raise ValueError("Not a dance response")
+
+    offset = DANCE_HEADER.size
+    track_ids = np.frombuffer(data, "<i4", count, offset)
+    scores = np.frombuffer(data, "<f4", count, offset + 4 * count)
+    current_scores = np.frombuffer(data, "<f4", count, offset + 8 * count)
+    poses = dequantize_poses(data, count, offset + 12 * count)
+
+    return {
+        "dropped": bool(flags & FLAG_DROPPED),
+        "step": step,
+        "timestamp": timestamp,
+        "latency": latency,
+        "queue": queue,
+        "dancers": {
+            int(track_id): {
+                "pose": pose,
+                "score": float(score),
+                "currentScore": float(current_score),
+            }
+            for track_id, pose, score, current_score in zip(
+                track_ids, poses, scores, current_scores
+            )
+        },
+    }
+
+
+def encode_prepare_response(result: "Results | None") -> bytes:
+    # Track ids, pixel boxes and pixel keypoints, everything the client needs
+    # to pick its players out of the full ultralytics summary
+    count = 0 if result is None else len(result.boxes)
+    header = PREPARE_HEADER.pack(PREPARE_MAGIC, VERSION, count)
+    if result is None or count == 0:
+        return header
+
+    boxes = result.boxes
+
+    if boxes.id is None:
+        track_ids = np.full(count, -1, dtype="<i4")
+    else:
+        track_ids = boxes.id.cpu().numpy().astype("<i4")
+    xyxy = boxes.xyxy.cpu().numpy()
+    keypoints = result.keypoints.data.cpu().numpy()
+
+    return b"".join(
+        [
+            header,
+            track_ids.tobytes(),
+            np.clip(np.rint(xyxy), 0, 0xFFFF).astype("<u2").tobytes(),
+            np.clip(np.rint(keypoints[..., :2]), 0, 0xFFFF).astype("<u2").tobytes(),
+            np.rint(np.clip(keypoints[..., 2], 0, 1) * CONFIDENCE_SCALE)
+            .astype(np.uint8)
+            .tobytes(),
+        ]
+    )
+
+
+def decode_prepare_response(data: bytes) -> List[Dict[str, Any]]:
+    (magic, version, count) = PREPARE_HEADER.unpack_from(data)
+    if magic != PREPARE_MAGIC or version != VERSION:
+        raise ValueError("Not a prepare response")
+
+    offset = PREPARE_HEADER.size
+    track_ids = np.frombuffer(data, "<i4", count, offset)
+    offset += 4 * count
+    boxes = np.frombuffer(data, "<u2", count * 4, offset).reshape(count, 4)
+    offset += 8 * count
+    xy = np.frombuffer(data, "<u2", count * 17 * 2, offset).reshape(count, 17, 2)
+    offset += 68 * count
+    visible = np.frombuffer(data, np.uint8, count * 17, offset).reshape(count, 17)
+
+    detections = []
+    for i in range(count):
+        (x1, y1, x2, y2) = boxes[i].tolist()
+        detection: Dict[str, Any] = {
+            "box": {"x1": x1, "y1": y1, "x2": x2, "y2": y2},
+            "keypoints": {
+                "x": xy[i, :, 0].tolist(),
+                "y": xy[i, :, 1].tolist(),
+                "visible": (visible[i] / CONFIDENCE_SCALE).tolist(),
+            },
+        }
+        if track_ids[i] >= 0:
+            detection["track_id"] = int(track_ids[i])
+        detections.append(detection)
+    return detections
@@ -1,9 +1,24 @@
+import os
 from io import BytesIO
 
-from flask import Blueprint, render_template, request, send_file
-
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    render_template,
+    request,
+    send_file,
+)
+
+from flaskr import metrics
+from flaskr.cache import cache_stats
 from flaskr.db import get_db
-from flaskr.videos import get_steps, save_video
+from flaskr.db.leaderboard import get_references
+from flaskr.db.writer import get_writer
+from flaskr.frames import frame_stats
+from flaskr.pose import get_pool
+from flaskr.videos import get_reference_file, get_steps, get_thumbnail, save_video
+from flaskr.videos.jobs import get_job, get_jobs, submit_job
 
 app_routes = Blueprint("app", __name__)
 
@@ -11,71 +26,15 @@ app_routes = Blueprint("app", __name__)
 @app_routes.route("/")
 def home():
     sort_param = request.args.get("sort")
-    cursor = get_db().cursor()
-
-    base_query = """
-    WITH HighestScores AS (
-        SELECT 
-            s.reference_id,
-            MAX(d.score) as max_score
-        FROM Sessions s
-        LEFT JOIN Dancers d ON s.session_id = d.session_id
-        GROUP BY s.reference_id
-    ),
-    ScoreAvatars AS (
-        SELECT 
-            s.reference_id,
-            d.avatar,
-            d.score,
-            ROW_NUMBER() OVER (PARTITION BY s.reference_id ORDER BY d.score DESC) as rn
-        FROM Sessions s
-        JOIN Dancers d ON s.session_id = d.session_id
-    )
-    SELECT 
-        r.reference_id,
-        r.title,
-        COALESCE(hs.max_score, 0) as highest_score,
-        sa.reference_id as highest_scorer_id
-    FROM "References" r
-    LEFT JOIN HighestScores hs ON r.reference_id = hs.reference_id
-    LEFT JOIN ScoreAvatars sa ON r.reference_id = sa.reference_id AND sa.rn = 1
-    """
 
     if sort_param == "recent":
         label = "Recently played"
-        # Order by the most recent session
-        query = (
-            base_query
-            + """
-        ORDER BY (
-            SELECT MAX(session_id)
-            FROM Sessions s2
-            WHERE s2.reference_id = r.reference_id
-        ) DESC
-        """
-        )
     elif sort_param == "collection":
         label = "Collection"
-        # Show only selected references
-        query = (
-            base_query
-            + """
-        WHERE r.selected = 1
-        ORDER BY r.reference_id
-        """
-        )
     else:
         label = "Home"
-        # Default ordering by reference_id
-        query = (
-            base_query
-            + """
-        ORDER BY r.reference_id
-        """
-        )
 
-    cursor.execute(query)
-    videos = cursor.fetchall()
+    videos = get_references(get_db(), sort_param)
 
     # Convert videos to list of dictionaries
     videos_data = [
@@ -96,43 +55,123 @@ def home():
 @app_routes.route("/dance")
 @app_routes.route("/dance/<reference_id>")
 def dance(reference_id=None):
-    return render_template("dance.html", reference_id=reference_id)
+    return render_template(
+        "dance.html",
+        reference_id=reference_id,
+        scoring_mode=current_app.config["SCORING_MODE"],
+        scoring_subdivisions=current_app.config["SCORING_SUBDIVISIONS"],
+    )
 
 
 @app_routes.route("/reference", methods=["POST"])
 def upload_video():
     if "file" not in request.files:
         return "No file part", 400
-    id = save_video(request.files["file"])
+    file = request.files["file"]
+    path = save_video(file)
 
-    if id is None:
-        return "Failed to upload to database", 500
+    if path is None:
+        return "Only mp4 videos can be uploaded", 400
 
-    return {"reference_id": id}
+    job_id = submit_job(path, file.filename or os.path.basename(path))
+    return {"job_id": job_id}, 202
+
+
+@app_routes.route("/jobs")
+def get_ingest_jobs():
+    return get_jobs()
+
+
+@app_routes.route("/jobs/<int:job_id>")
+def get_ingest_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return "No such job", 404
+    return job
 
 
 @app_routes.route("/reference/<int:reference_id>")
 def get_reference_video(reference_id):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        'SELECT filepath FROM "References" WHERE reference_id = ?', (reference_id,)
+    reference_file = get_reference_file(reference_id)
+    if reference_file is None:
+        return "No such reference", 404
+
+    try:
+        stat = os.stat(reference_file.path)
+    except FileNotFoundError:
+        return "No such reference", 404
+
+    # Range requests let the player seek, and revalidation answers repeated
+    # plays with a 304 instead of the whole video. An upload with the same
+    # name replaces the file without touching the stored content hash, so
+    # the ETag also follows the file's mtime and size
+    etag = f"{reference_file.content_hash}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    return send_file(
+        reference_file.path,
+        mimetype="video/mp4",
+        conditional=True,
+        etag=etag,
+        max_age=current_app.config["MEDIA_MAX_AGE"],
     )
-    result = cursor.fetchone()
-    return send_file(result[0])
 
 
 @app_routes.route("/reference/<int:reference_id>/thumbnail")
 def get_reference_thumbnail(reference_id):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        'SELECT thumbnail FROM "References" WHERE reference_id = ?', (reference_id,)
+    thumbnail = get_thumbnail(reference_id)
+    if thumbnail is None:
+        return "No thumbnail", 404
+    return send_file(
+        BytesIO(thumbnail.data),
+        mimetype="image/jpeg",
+        conditional=True,
+        etag=thumbnail.etag,
+        max_age=current_app.config["MEDIA_MAX_AGE"],
     )
-    result = cursor.fetchone()
-    return send_file(BytesIO(result[0]), mimetype="image/jpeg")
 
 
 @app_routes.route("/reference/<int:reference_id>/steps", methods=["GET"])
 def get_reference_steps(reference_id):
     return get_steps(reference_id)
+
+
+@app_routes.route("/stats/cache")
+def get_cache_stats():
+    return cache_stats()
+
+
+@app_routes.route("/stats/db")
+def get_db_stats():
+    return get_writer().stats()
+
+
+@app_routes.route("/metrics")
+def get_metrics():
+    writer = get_writer().stats()
+    samples = [
+        *metrics.stats_samples(
+            "pose_pool", get_pool().stats(), counters=("checkouts", "timeouts")
+        ),
+        *metrics.stats_samples(
+            "db_writer", writer, counters=("writes", "commits", "errors")
+        ),
+    ]
+    for name, stats in cache_stats().items():
+        samples.extend(
+            metrics.stats_samples(
+                "cache",
+                stats,
+                (("cache", name),),
+                counters=("hits", "misses", "evictions"),
+            )
+        )
+    for transport, stats in frame_stats().items():
+        labels = (("transport", transport),)
+        samples.extend(
+            metrics.stats_samples(
+                "frame_transport", stats, labels, counters=("frames",)
+            )
+        )
+
+    return Response(
+        metrics.render(samples), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,16 +1,31 @@
-import json
+import multiprocessing
 import os
 import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 
 import click
 import cv2
 from flask import Flask, current_app
-from ultralytics import YOLO
 from werkzeug.utils import secure_filename
 
 import steps
-from flaskr.videos import upload_reference
-from steps.video import track_pose
+from flaskr import cache
+from flaskr.db import get_db
+from flaskr.pose import get_pool
+from flaskr.pose.backends import BACKENDS, export_model
+from flaskr.scripts import bench
+from flaskr.videos import (
+    ProcessedReference,
+    analyze_beats,
+    file_hash,
+    find_reference,
+    process_reference,
+    store_reference,
+)
+from flaskr.videos.jobs import init_worker, process_file
 
 
 @click.command("plot-beats")
@@ -22,8 +37,7 @@ def plot_beats_command(path):
 @click.command("show-steps")
 @click.argument("path")
 def show_steps_command(path):
-    with open(path, "rb") as file:
-        (_tempo, beats, _y, _sr) = steps.music.analyze_audio(file)
+    beats = analyze_beats(path)
 
     frames = steps.video.get_frames(path, beats) or []
 
@@ -41,12 +55,11 @@ def show_steps_command(path):
 @click.command("show-pose")
 @click.argument("path")
 def show_pose_command(path):
-    with open(path, "rb") as file:
-        (_tempo, beats, _y, _sr) = steps.music.analyze_audio(file)
+    beats = analyze_beats(path)
 
-    frames = steps.video.get_frames(path, beats) or []
-    poses = steps.video.track_pose(YOLO("yolo11n-pose.pt"), frames[:1])
-    result = list(poses)
+    frames = steps.video.get_frames(path, beats[:1]) or []
+    with get_pool().checkout() as model:
+        result = list(steps.video.track_pose(model, frames))
 
     running = len(result)
     while running:
@@ -63,25 +76,152 @@ def show_pose_command(path):
 @click.command("get-pose")
 @click.argument("path")
 def get_pose_command(path):
-    with open(path, "rb") as file:
-        (_tempo, beats, _y, _sr) = steps.music.analyze_audio(file)
-
-    beats = beats[:1]
-    frames = steps.video.get_frames(path, beats) or []
-    result = steps.video.get_main_pose(YOLO("yolo11n-pose.pt"), frames, beats)
-    print(result)
+    # Goes through the pose cache, filling it on a miss, so the output is the
+    # same whether or not the video was analysed before
+    processed = process_reference(path)
+    print((processed.timestamps[:1], processed.poses[:1]))
+
+
+@click.command("cache-stats")
+def cache_stats_command():
+    stats = cache.get_analysis_cache().stats()
+    click.echo(f"Folder:  {stats['folder']}")
+    click.echo(f"Entries: {stats['entries']}")
+    click.echo(
+        f"Size:    {stats['bytes'] / 1024 / 1024:.1f} MB"
+        f" of {stats['max_bytes'] / 1024 / 1024:.1f} MB"
+    )
+
+
+@click.command("cache-clear")
+def cache_clear_command():
+    removed = cache.get_analysis_cache().clear()
+    click.echo(f"Removed {removed} cached result(s).")
+
+
+@click.command("export-model")
+@click.option("--backend", type=click.Choice(BACKENDS), default=None)
+@click.option("--force", is_flag=True, help="Export again over an existing one")
+def export_model_command(backend, force):
+    config = current_app.config
+    path = export_model(
+        config["POSE_MODEL"],
+        backend or config["POSE_BACKEND"],
+        config["INFERENCE_IMGSZ"],
+        force,
+    )
+    click.echo(f"Pose model ready at {path}")
 
 
 @click.command("upload-video")
 @click.argument("paths", nargs=-1)
-def upload_video_command(paths):
+@click.option("--jobs", default=1, help="Worker processes, each with its own model")
+@click.option("--batch", default=10, help="References written per transaction")
+def upload_video_command(paths, jobs, batch):
+    started = time.perf_counter()
+    timings: Dict[str, float] = defaultdict(float)
+
+    def timed(stage: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[stage] += time.perf_counter() - start
+
+    pending = []
+    hashes = set()
+    skipped = 0
     for p in paths:
-        filename = os.path.basename(p)
+        content_hash = timed("hash", file_hash, p)
+        if content_hash in hashes or find_reference(content_hash) is not None:
+            click.echo(f"Skipping {p}, already imported")
+            skipped += 1
+            continue
+        hashes.add(content_hash)
+
+        pending.append((p, os.path.basename(p), content_hash))
+
+    db = get_db()
+    cursor = db.cursor()
+    written: List[int] = []
+    imported = 0
+    failed = 0
+
+    def commit():
+        timed("write", db.commit)
+        for reference_id in written:
+            cache.invalidate_reference(reference_id)
+        written.clear()
+
+    def store(item: Tuple[str, str, str], processed: ProcessedReference):
+        nonlocal imported
+
+        (source, filename, content_hash) = item
+        for stage, elapsed in processed.timings.items():
+            timings[stage] += elapsed
+
+        # Videos are processed where they are and only copied in once they
+        # made it, so failed imports leave nothing behind
         path = os.path.join(
             current_app.config["REFERENCES_FOLDER"], secure_filename(filename)
         )
-        shutil.copy(p, path)
-        upload_reference(path, filename, True)
+        try:
+            timed("copy", shutil.copy, source, path)
+            reference_id = timed(
+                "write",
+                store_reference,
+                cursor,
+                path,
+                filename,
+                True,
+                content_hash,
+                processed,
+            )
+        except Exception:
+            os.remove(path)
+            raise
+        written.append(reference_id)
+        imported += 1
+        click.echo(f"Imported {filename} as reference {reference_id}")
+
+        if len(written) >= batch:
+            commit()
+
+    if jobs > 1:
+        threads = max((os.cpu_count() or jobs) // jobs, 1)
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(threads,),
+        ) as executor:
+            futures = {
+                executor.submit(process_file, item[0], item[2]): item
+                for item in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    store(futures[future], future.result())
+                except Exception as e:
+                    click.echo(f"Failed to import {futures[future][1]}: {e}")
+                    failed += 1
+    else:
+        for item in pending:
+            try:
+                store(item, process_reference(item[0], content_hash=item[2]))
+            except Exception as e:
+                click.echo(f"Failed to import {item[1]}: {e}")
+                failed += 1
+
+    commit()
+
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"Imported {imported}, skipped {skipped}, failed {failed} in {elapsed:.2f}s"
+    )
+    click.echo(f"{'stage':<10} {'total s':>9} {'avg s':>8}")
+    for stage, total in timings.items():
+        click.echo(f"{stage:<10} {total:>9.2f} {total / max(imported, 1):>8.2f}")
 
 
 def init_app(app: Flask):
@@ -89,4 +229,20 @@ def init_app(app: Flask):
     app.cli.add_command(show_steps_command)
     app.cli.add_command(show_pose_command)
     app.cli.add_command(get_pose_command)
+    app.cli.add_command(export_model_command)
     app.cli.add_command(upload_video_command)
+    app.cli.add_command(cache_stats_command)
+    app.cli.add_command(cache_clear_command)
+    app.cli.add_command(bench.bench_frames_command)
+    app.cli.add_command(bench.bench_steps_command)
+    app.cli.add_command(bench.bench_grading_command)
+    app.cli.add_command(bench.bench_storage_command)
+    app.cli.add_command(bench.bench_extract_command)
+    app.cli.add_command(bench.bench_audio_command)
+    app.cli.add_command(bench.bench_home_command)
+    app.cli.add_command(bench.bench_window_command)
+    app.cli.add_command(bench.bench_roi_command)
+    app.cli.add_command(bench.bench_backend_command)
+    app.cli.add_command(bench.bench_startup_command)
+    app.cli.add_command(bench.bench_load_command)
+    app.cli.add_command(bench.bench_responses_command)
@@ -0,0 +1,1200 @@
+import base64
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+import click
+import cv2
+import ffmpeg
+import numpy as np
+from cv2.typing import MatLike
+from flask import current_app
+
+import steps
+from flaskr import cache, frames, responses
+from flaskr.db.leaderboard import get_references, rebuild_leaderboard, record_scores
+from flaskr.db.migrations import steps_to_timelines
+from flaskr.pose.backends import BACKENDS, load_model
+from steps.timeline import StepTimeline
+from steps.video import (
+    RegionOfInterest,
+    create_tracker,
+    get_frames,
+    grade_pose_array,
+    grade_pose_windows,
+    grade_poses,
+    iter_frames,
+    pose_arrays,
+    shift_result,
+    update_tracker,
+)
+
+if TYPE_CHECKING:
+    from ultralytics.engine.results import Results
+
+
+def synthetic_frame(width=640, height=480, seed=0) -> MatLike:
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    frame = np.dstack([np.tile(gradient, (height, 1))] * 3)
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.circle(frame, center, int(rng.integers(10, 80)), color, -1)
+    noise = rng.integers(0, 16, frame.shape, dtype=np.uint8)
+    return cv2.add(frame, noise)
+
+
+def load_frame(path: str | None, width: int, height: int) -> MatLike:
+    if path is None:
+        return synthetic_frame(width, height)
+
+    frame = cv2.imread(path)
+    if frame is None:
+        cap = cv2.VideoCapture(path)
+        _, frame = cap.read()
+        cap.release()
+    if frame is None:
+        raise click.ClickException(f"Could not read a frame from {path}")
+    return frame
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+@click.command("bench-frames")
+@click.argument("path", required=False)
+@click.option("--width", default=640, help="Synthetic frame width")
+@click.option("--height", default=480, help="Synthetic frame height")
+@click.option("--iterations", default=200)
+def bench_frames_command(path, width, height, iterations):
+    frame = load_frame(path, width, height)
+    _, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    data_url = "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()
+
+    payloads = {
+        "data-url": data_url,
+        "binary jpeg": frames.encode_frame(frame, frames.FORMAT_JPEG),
+        "binary bgr": frames.encode_frame(frame, frames.FORMAT_BGR),
+        "binary gray": frames.encode_frame(frame, frames.FORMAT_GRAY),
+    }
+
+    click.echo(f"Frame {frame.shape[1]}x{frame.shape[0]}, {iterations} iterations")
+    click.echo(f"{'transport':<12} {'bytes/frame':>12} {'decode ms':>10}")
+    for name, payload in payloads.items():
+        elapsed = timed(lambda: frames.decode_frame(payload), iterations)
+        click.echo(f"{name:<12} {len(payload):>12} {elapsed * 1000:>10.3f}")
+
+
+@click.command("bench-steps")
+@click.option("--minutes", default=12.0, help="Length of the synthetic reference")
+@click.option("--bpm", default=128.0)
+@click.option("--jitter", default=0.01, help="Max timestamp drift in seconds")
+@click.option("--tolerance", default=0.05)
+def bench_steps_command(minutes, bpm, jitter, tolerance):
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(0, minutes * 60, 60 / bpm)
+    poses = rng.random((len(timestamps), 17, 3))
+    steps = [(float(t), p.tolist()) for t, p in zip(timestamps, poses)]
+    queries = timestamps + rng.uniform(-jitter, jitter, len(timestamps))
+
+    def scan():
+        found = 0
+        for timestamp in queries:
+            current_step = None
+            for step in steps:
+                if abs(step[0] - timestamp) < 0.001:
+                    current_step = step[1]
+            found += current_step is not None
+        return found
+
+    timeline = StepTimeline.from_steps(steps)
+
+    def lookup():
+        return sum(timeline.find(t, tolerance) is not None for t in queries)
+
+    click.echo(f"{len(steps)} steps over {minutes} minutes, jitter +-{jitter}s")
+    for name, fn in [("linear scan", scan), ("timeline", lookup)]:
+        start = time.perf_counter()
+        found = fn()
+        elapsed = (time.perf_counter() - start) / len(queries)
+        click.echo(
+            f"{name:<12} {elapsed * 1e6:>10.2f} us/frame  "
+            f"{found}/{len(queries)} frames matched"
+        )
+
+
+def legacy_grade_poses(pose_a, pose_b, scaling_factor=1.0):
+    # grade_poses before it was vectorized, kept as the benchmark baseline
+    pose_a = np.array(pose_a)
+    pose_b = np.array(pose_b)
+
+    for pose in [pose_a, pose_b]:
+        low_confidence_mask = pose[:, 0] < 0.5
+        pose[low_confidence_mask, 1:] = 0.5
+
+    weights = [2, 2, 2, 2, 2, 12, 12, 8, 8, 8, 8, 12, 12, 6, 6, 4, 4]
+
+    scores = []
+    for i in range(17):
+        weight = weights[i]
+
+        if pose_a[i, 0] >= 0.5 or pose_b[i, 0] >= 0.5:
+            distance = np.sqrt(np.sum((pose_a[i, 1:] - pose_b[i, 1:]) ** 2))
+            similarity = np.exp(-distance * 2) * weight
+
+            confidence_factor = (pose_a[i, 0] + pose_b[i, 0]) / 2
+            similarity = similarity * confidence_factor * scaling_factor
+
+            scores.append(similarity)
+        else:
+            scores.append(weight * 0.5 * scaling_factor)
+
+    final_score = sum(scores)
+    final_score = min(max(final_score, 0), 100)
+
+    return round(final_score, 2)
+
+
+@click.command("bench-grading")
+@click.option("--dancers", default=4, help="Dancers graded per frame")
+@click.option("--iterations", default=2000)
+def bench_grading_command(dancers, iterations):
+    rng = np.random.default_rng(0)
+    poses = rng.random((iterations, dancers, 17, 3))
+    reference = rng.random((iterations, 17, 3))
+    pose_lists = poses.tolist()
+    reference_lists = reference.tolist()
+
+    legacy = np.array(
+        [
+            [legacy_grade_poses(p, reference_lists[i]) for p in pose_lists[i]]
+            for i in range(iterations)
+        ]
+    )
+    batched = grade_pose_array(poses, reference[:, None])
+    mismatches = int(np.count_nonzero(legacy != batched))
+
+    def run_legacy():
+        for i in range(iterations):
+            for pose in pose_lists[i]:
+                legacy_grade_poses(pose, reference_lists[i])
+
+    def run_single():
+        for i in range(iterations):
+            for pose in pose_lists[i]:
+                grade_poses(pose, reference_lists[i])
+
+    def run_batched():
+        for i in range(iterations):
+            grade_pose_array(poses[i], reference[i])
+
+    click.echo(f"{dancers} dancers x {iterations} frames, {mismatches} mismatches")
+    for name, fn in [
+        ("legacy", run_legacy),
+        ("per dancer", run_single),
+        ("batched", run_batched),
+    ]:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"{name:<12} {elapsed / iterations * 1e6:>10.2f} us/frame  "
+            f"{dancers * iterations / elapsed:>12.0f} dancers/s"
+        )
+
+
+@click.command("bench-storage")
+@click.option("--minutes", default=20.0, help="Length of the synthetic reference")
+@click.option("--bpm", default=128.0)
+@click.option("--iterations", default=20)
+def bench_storage_command(minutes, bpm, iterations):
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(0, minutes * 60, 60 / bpm)
+    poses = rng.random((len(timestamps), 17, 3)).round(5)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.sqlite")
+        db = sqlite3.connect(path)
+        db.execute(
+            "CREATE TABLE Steps (step_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "reference_id INTEGER NOT NULL, timestamp REAL NOT NULL, pose TEXT NOT NULL)"
+        )
+        db.executemany(
+            "INSERT INTO Steps (reference_id, timestamp, pose) VALUES (?, ?, ?)",
+            [(1, float(t), json.dumps(p.tolist())) for t, p in zip(timestamps, poses)],
+        )
+        db.commit()
+        db.execute("VACUUM")
+        json_size = os.path.getsize(path)
+
+        def load_json():
+            rows = db.execute(
+                "SELECT timestamp, pose FROM Steps WHERE reference_id = ? ORDER BY timestamp ASC",
+                (1,),
+            ).fetchall()
+            return [(r[0], json.loads(r[1])) for r in rows]
+
+        json_time = timed(load_json, iterations)
+
+        # Only the steps migration, the scratch database has no other tables
+        steps_to_timelines(db)
+        db.commit()
+        db.execute("VACUUM")
+        blob_size = os.path.getsize(path)
+
+        def load_blob():
+            row = db.execute(
+                'SELECT timestamps, poses FROM "Timelines" WHERE reference_id = ?',
+                (1,),
+            ).fetchone()
+            return (
+                np.frombuffer(row[0], dtype="<f8"),
+                np.frombuffer(row[1], dtype="<f4").reshape(-1, 17, 3),
+            )
+
+        blob_time = timed(load_blob, iterations)
+        db.close()
+
+    click.echo(f"{len(timestamps)} steps over {minutes} minutes")
+    click.echo(f"{'storage':<10} {'db bytes':>12} {'load ms':>10}")
+    click.echo(f"{'json rows':<10} {json_size:>12} {json_time * 1000:>10.3f}")
+    click.echo(f"{'blobs':<10} {blob_size:>12} {blob_time * 1000:>10.3f}")
+
+
+def write_synthetic_video(path: str, seconds: float, fps=30, width=1280, height=720):
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
+    )
+    background = synthetic_frame(width, height)
+    for i in range(round(seconds * fps)):
+        frame = background.copy()
+        x = int((i * 7) % width)
+        cv2.rectangle(
+            frame, (x, height // 3), (x + 120, height // 3 + 240), (0, 0, 255), -1
+        )
+        writer.write(frame)
+    writer.release()
+
+
+@click.command("bench-extract")
+@click.argument("path", required=False)
+@click.option("--seconds", default=120.0, help="Length of the synthetic video")
+@click.option("--bpm", default=128.0)
+@click.option("--max-size", default=640, help="Downscale for the sequential mode")
+def bench_extract_command(path, seconds, bpm, max_size):
+    with tempfile.TemporaryDirectory() as folder:
+        if path is None:
+            path = os.path.join(folder, "bench.mp4")
+            write_synthetic_video(path, seconds)
+
+        cap = cv2.VideoCapture(path)
+        duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+        timestamps = np.arange(0, duration - 0.5, 60 / bpm)
+
+        def seek():
+            return len(get_frames(path, timestamps, sequential=False) or [])
+
+        def sequential():
+            return sum(1 for _ in iter_frames(path, timestamps))
+
+        def downscaled():
+            return sum(1 for _ in iter_frames(path, timestamps, max_size))
+
+        click.echo(f"{len(timestamps)} beats over {duration:.1f}s of video")
+        click.echo(f"{'mode':<12} {'seconds':>8} {'frames':>7} {'peak MB':>8}")
+        for name, fn in [
+            ("seek", seek),
+            ("sequential", sequential),
+            (f"seq {max_size}px", downscaled),
+        ]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = fn()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            click.echo(
+                f"{name:<12} {elapsed:>8.2f} {count:>7} {peak / 1024 / 1024:>8.1f}"
+            )
+
+
+def legacy_analyze_audio(path: str):
+    # analyze_audio before it streamed, kept as the benchmark baseline
+    import librosa
+
+    with open(path, "rb") as video_file:
+        out, _ = (
+            ffmpeg.input("pipe:0")
+            .output("pipe:1", format="wav", acodec="pcm_s16le", ar="44100")
+            .run(input=video_file.read(), capture_stdout=True, capture_stderr=True)
+        )
+
+    audio_bytes = io.BytesIO(out)
+    audio_bytes.seek(0)
+
+    y, sr = librosa.load(audio_bytes, sr=None)
+    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr)
+
+    return (tempo, beat_times, y, sr)
+
+
+def write_synthetic_song(path: str, seconds: float):
+    video = ffmpeg.input("color=c=black:s=320x240:r=10", f="lavfi", t=seconds)
+    audio = ffmpeg.input(
+        "sine=frequency=220:beep_factor=4:sample_rate=44100", f="lavfi", t=seconds
+    )
+    ffmpeg.output(
+        video, audio, path, ac=2, vcodec="mpeg4", acodec="aac", movflags="+faststart"
+    ).run(quiet=True, overwrite_output=True)
+
+
+@click.command("bench-audio")
+@click.argument("path", required=False)
+@click.option("--seconds", default=600.0, help="Length of the synthetic video")
+def bench_audio_command(path, seconds):
+    with tempfile.TemporaryDirectory() as folder:
+        if path is None:
+            path = os.path.join(folder, "bench.mp4")
+            write_synthetic_song(path, seconds)
+
+        click.echo(f"{os.path.getsize(path) / 1024 / 1024:.1f} MB video {path}")
+        click.echo(f"{'mode':<10} {'seconds':>8} {'peak MB':>8} {'beats':>6}")
+        for name, fn in [
+            ("in-memory", legacy_analyze_audio),
+            ("streaming", steps.music.analyze_audio),
+        ]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            beats = fn(path)[1]
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            click.echo(
+                f"{name:<10} {elapsed:>8.2f} {peak / 1024 / 1024:>8.1f} {len(beats):>6}"
+            )
+
+
+# Home page query before the Leaderboard table, kept for comparison
+LEGACY_HOME_QUERY = """
+WITH HighestScores AS (
+    SELECT s.reference_id, MAX(d.score) as max_score
+    FROM Sessions s
+    LEFT JOIN Dancers d ON s.session_id = d.session_id
+    GROUP BY s.reference_id
+),
+ScoreAvatars AS (
+    SELECT
+        s.reference_id,
+        d.avatar,
+        d.score,
+        ROW_NUMBER() OVER (PARTITION BY s.reference_id ORDER BY d.score DESC) as rn
+    FROM Sessions s
+    JOIN Dancers d ON s.session_id = d.session_id
+)
+SELECT
+    r.reference_id,
+    r.title,
+    COALESCE(hs.max_score, 0) as highest_score,
+    sa.reference_id as highest_scorer_id
+FROM "References" r
+LEFT JOIN HighestScores hs ON r.reference_id = hs.reference_id
+LEFT JOIN ScoreAvatars sa ON r.reference_id = sa.reference_id AND sa.rn = 1
+ORDER BY (
+    SELECT MAX(session_id) FROM Sessions s2 WHERE s2.reference_id = r.reference_id
+) DESC
+"""
+
+
+@click.command("bench-home")
+@click.option("--references", default=100)
+@click.option("--dancers", default=1_000_000, help="Dancer rows in the last round")
+@click.option("--iterations", default=3)
+def bench_home_command(references, dancers, iterations):
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite3.connect(os.path.join(folder, "bench.sqlite"))
+        db.row_factory = sqlite3.Row
+        with current_app.open_resource("db/schema.sql") as f:
+            db.executescript(f.read().decode("utf8"))
+        db.executemany(
+            'INSERT INTO "References" (filepath, title, selected) VALUES (?, ?, ?)',
+            [(f"{i}.mp4", f"Reference {i}", i % 2) for i in range(references)],
+        )
+
+        click.echo(
+            f"{'dancers':>10} {'legacy ms':>10} {'table ms':>10} {'finish ms':>10}"
+        )
+        seeded = 0
+        for target in sorted({dancers // 100, dancers // 10, dancers}):
+            # Two dancers per session, spread over every reference
+            sessions = (target - seeded) // 2
+            reference_ids = rng.integers(1, references + 1, sessions)
+            for reference_id in reference_ids:
+                session_id = db.execute(
+                    'INSERT INTO "Sessions" (reference_id) VALUES (?)',
+                    (int(reference_id),),
+                ).lastrowid
+                db.executemany(
+                    'INSERT INTO "Dancers" (session_id, score) VALUES (?, ?)',
+                    [(session_id, int(s)) for s in rng.integers(0, 100, 2)],
+                )
+            seeded += sessions * 2
+            rebuild_leaderboard(db)
+            db.commit()
+
+            legacy = timed(lambda: db.execute(LEGACY_HOME_QUERY).fetchall(), iterations)
+            table = timed(lambda: get_references(db, "recent"), iterations * 100)
+            finish = timed(
+                lambda: record_scores(db, 1, [(1, int(rng.integers(0, 100)))]),
+                iterations * 100,
+            )
+            db.rollback()
+            click.echo(
+                f"{seeded:>10} {legacy * 1000:>10.2f} {table * 1000:>10.3f} "
+                f"{finish * 1000:>10.4f}"
+            )
+
+        db.close()
+
+
+def synthetic_dance(timestamps: np.ndarray, dancers=1) -> np.ndarray:
+    # Keypoints swaying smoothly with time, (dancers x len(timestamps) x 17 x 3)
+    phase = np.linspace(0, np.pi, 17)
+    t = np.asarray(timestamps)[:, None]
+    poses = np.empty((len(timestamps), 17, 3))
+    poses[..., 0] = 0.9
+    poses[..., 1] = 0.5 + 0.2 * np.sin(2 * np.pi * 0.5 * t + phase)
+    poses[..., 2] = 0.5 + 0.2 * np.cos(2 * np.pi * 0.7 * t + phase)
+    return np.broadcast_to(poses, (dancers, *poses.shape)).copy()
+
+
+@click.command("bench-window")
+@click.option("--seconds", default=60.0, help="Length of the synthetic reference")
+@click.option("--bpm", default=128.0)
+@click.option("--subdivisions", default=4)
+@click.option("--dancers", default=4)
+@click.option("--offset", default=0.15, help="How late the synthetic dancer is")
+def bench_window_command(seconds, bpm, subdivisions, dancers, offset):
+    beats = np.arange(0, seconds, 60 / bpm)
+    timeline = StepTimeline(beats, synthetic_dance(beats)[0].astype(np.float32))
+    trajectory = timeline.trajectory(subdivisions)
+
+    # The client samples at the trajectory rate, stamped with capture time
+    live_timestamps = trajectory.timestamps
+    live_poses = synthetic_dance(live_timestamps - offset, dancers)
+    live_visible = np.ones((dancers, len(live_timestamps)), dtype=np.bool_)
+
+    def score_beats(window: float) -> float:
+        total = 0.0
+        for beat in timeline.timestamps:
+            live = np.abs(live_timestamps - beat) <= window
+            (lo, hi) = np.searchsorted(
+                trajectory.timestamps, [beat - 2 * window, beat + 2 * window]
+            )
+            (scores, _) = grade_pose_windows(
+                live_timestamps[live],
+                live_poses[:, live],
+                live_visible[:, live],
+                trajectory.timestamps[lo:hi],
+                trajectory.poses[lo:hi],
+                window,
+            )
+            total += scores[0]
+        return total / len(timeline)
+
+    on_beat = live_poses[:, ::subdivisions]
+    beat_score = grade_pose_array(on_beat, timeline.poses).mean(axis=-1)[0]
+    beat_time = timed(lambda: grade_pose_array(on_beat[:, 0], timeline.poses[0]), 200)
+
+    click.echo(
+        f"{len(timeline)} beats, {subdivisions} samples per beat, "
+        f"{dancers} dancers {offset * 1000:.0f} ms late"
+    )
+    click.echo(
+        f"{'mode':<12} {'samples':>8} {'score':>8} {'us/beat':>10} {'us/frame':>10}"
+    )
+    click.echo(
+        f"{'beat':<12} {1:>8} {beat_score:>8.2f} "
+        f"{beat_time * 1e6:>10.1f} {beat_time * 1e6:>10.1f}"
+    )
+
+    for window in (0.05, 0.1, 0.2, 0.3, 0.5):
+        elapsed = timed(lambda: score_beats(window), 3)
+        per_beat = elapsed / len(timeline)
+        samples = int(
+            np.sum(np.abs(live_timestamps - beats[len(beats) // 2]) <= window)
+        )
+        click.echo(
+            f"{f'window {window}':<12} {samples:>8} {score_beats(window):>8.2f} "
+            f"{per_beat * 1e6:>10.1f} {per_beat / subdivisions * 1e6:>10.1f}"
+        )
+
+
+def read_frames(path: str, max_frames: int) -> List[MatLike]:
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise click.ClickException(f"Could not read frames from {path}")
+    return frames
+
+
+def main_pose(result: "Results") -> np.ndarray | None:
+    # The largest dancer stands in for the player being scored
+    (_ids, xyxyn, poses) = pose_arrays(result)
+    if len(poses) == 0:
+        return None
+    area = (xyxyn[:, 2] - xyxyn[:, 0]) * (xyxyn[:, 3] - xyxyn[:, 1])
+    return poses[np.argmax(area)]
+
+
+def pose_agreement(
+    poses: List[np.ndarray | None], baseline: List[np.ndarray | None]
+) -> Tuple[float, float, float]:
+    both = [(p, b) for p, b in zip(poses, baseline) if p is not None and b is not None]
+    detected = sum(p is not None for p in poses) / len(poses)
+    if not both:
+        return (detected, 0.0, 0.0)
+
+    (a, b) = (np.array([p for p, _ in both]), np.array([b for _, b in both]))
+    # Grading the pose against the baseline one is what scoring sees
+    agreement = grade_pose_array(a, b).mean()
+    error = np.abs(a[..., 1:] - b[..., 1:]).mean()
+    return (detected, agreement, error)
+
+
+@click.command("bench-roi")
+@click.argument("path")
+@click.option("--imgsz", default=320, help="Reduced inference size to compare")
+@click.option("--margin", default=0.15)
+@click.option("--redetect", default=15, help="Full frame every N frames")
+@click.option("--frames", "max_frames", default=300)
+def bench_roi_command(path, imgsz, margin, redetect, max_frames):
+    frames = read_frames(path, max_frames)
+    (height, width) = frames[0].shape[:2]
+
+    from ultralytics import YOLO
+
+    model = YOLO(current_app.config["POSE_MODEL"])
+
+    def run(size: int, roi: RegionOfInterest | None):
+        model.predict(frames[0], imgsz=size, verbose=False)
+        tracker = create_tracker(current_app.config["POSE_TRACKER"])
+        poses = []
+
+        start = time.perf_counter()
+        for frame in frames:
+            (image, offset) = (frame, None) if roi is None else roi.crop(frame)
+            result = model.predict(image, imgsz=size, verbose=False)[0]
+            if offset is not None:
+                result = shift_result(result, frame, offset)
+            result = update_tracker(tracker, result)
+            if roi is not None:
+                roi.update(result.boxes.xyxy.cpu().numpy(), width, height)
+            poses.append(main_pose(result))
+
+        return (len(frames) / (time.perf_counter() - start), poses)
+
+    (baseline_fps, baseline) = run(640, None)
+    runs = [
+        ("full 640", baseline_fps, baseline),
+        (f"full {imgsz}", *run(imgsz, None)),
+        ("roi 640", *run(640, RegionOfInterest(margin, redetect))),
+        (f"roi {imgsz}", *run(imgsz, RegionOfInterest(margin, redetect))),
+    ]
+
+    click.echo(f"{len(frames)} frames of {width}x{height}, redetect every {redetect}")
+    click.echo(
+        f"{'mode':<10} {'fps':>8} {'detected':>9} {'agreement':>10} {'kp error':>9}"
+    )
+    for name, fps, poses in runs:
+        (detected, agreement, error) = pose_agreement(poses, baseline)
+        click.echo(
+            f"{name:<10} {fps:>8.1f} {detected:>9.0%} {agreement:>10.2f} {error:>9.4f}"
+        )
+
+
+@click.command("bench-backend")
+@click.argument("path")
+@click.option(
+    "--backend",
+    "backends",
+    multiple=True,
+    type=click.Choice(BACKENDS),
+    help="Backends to compare, all by default",
+)
+@click.option("--threads", type=int, help="Intra-op threads per model")
+@click.option("--batch", default=1, help="Frames per predict call")
+@click.option("--imgsz", default=640)
+@click.option("--conf", default=0.25, help="Detection confidence threshold")
+@click.option("--frames", "max_frames", default=300)
+def bench_backend_command(path, backends, threads, batch, imgsz, conf, max_frames):
+    frames = read_frames(path, max_frames)
+    weights = current_app.config["POSE_MODEL"]
+
+    def run(backend: str):
+        model = load_model(weights, backend, threads, imgsz)
+        poses = []
+
+        start = time.perf_counter()
+        for i in range(0, len(frames), batch):
+            results = model.predict(
+                frames[i : i + batch], imgsz=imgsz, conf=conf, verbose=False
+            )
+            poses.extend(main_pose(result) for result in results)
+
+        return (len(frames) / (time.perf_counter() - start), poses)
+
+    # PyTorch always runs first, the exports are graded against it
+    runs = [("torch", *run("torch"))]
+    for backend in backends or BACKENDS:
+        if backend == "torch":
+            continue
+        try:
+            runs.append((backend, *run(backend)))
+        except Exception as e:
+            click.echo(f"Skipping {backend}: {e}")
+
+    (height, width) = frames[0].shape[:2]
+    click.echo(
+        f"{len(frames)} frames of {width}x{height} at {imgsz}, batch {batch}, "
+        f"{threads or 'default'} threads"
+    )
+    click.echo(
+        f"{'backend':<10} {'fps':>8} {'detected':>9} {'agreement':>10} {'kp error':>9}"
+    )
+    baseline = runs[0][2]
+    for name, fps, poses in runs:
+        (detected, agreement, error) = pose_agreement(poses, baseline)
+        click.echo(
+            f"{name:<10} {fps:>8.1f} {detected:>9.0%} {agreement:>10.2f} {error:>9.4f}"
+        )
+
+
+def import_times(stderr: str) -> Dict[str, float]:
+    # Cumulative seconds of each top level import in `python -X importtime` output
+    times = dict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        (_self, cumulative, name) = line[len("import time:") :].split("|")
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@click.command("bench-startup")
+@click.option("--command", "commands", multiple=True, help="Only these commands")
+@click.option("--top", default=3, help="Heaviest imports listed per target")
+def bench_startup_command(commands, top):
+    app_module = current_app.import_name
+    targets = [
+        ("web server", ["-c", f"from {app_module} import create_app; create_app()"])
+    ]
+    for name in commands or sorted(current_app.cli.commands):
+        targets.append((name, ["-m", "flask", "--app", app_module, name, "--help"]))
+
+    click.echo(f"{'target':<20} {'wall ms':>8} {'import ms':>10}  heaviest imports")
+    for name, args in targets:
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            cwd=os.path.dirname(current_app.root_path),
+            capture_output=True,
+            text=True,
+        )
+        wall = time.perf_counter() - start
+        if process.returncode != 0:
+            click.echo(f"{name:<20} failed: {process.stderr.splitlines()[-1:]}")
+            continue
+
+        times = import_times(process.stderr)
+        heaviest = sorted(times.items(), key=lambda t: t[1], reverse=True)[:top]
+        click.echo(
+            f"{name:<20} {wall * 1000:>8.0f} {sum(times.values()) * 1000:>10.0f}  "
+            + ", ".join(f"{module} {t * 1000:.0f}" for module, t in heaviest)
+        )
+
+
+def stamp_frame(payload: bytes, timestamp: float) -> bytes:
+    # Rewrites the timestamp of an encoded frame without encoding it again
+    (magic, version, format, width, height, _) = frames.HEADER.unpack_from(payload)
+    header = frames.HEADER.pack(magic, version, format, width, height, timestamp)
+    return header + payload[frames.HEADER.size :]
+
+
+def sample_times(timestamps: List[float], subdivisions: int) -> List[float]:
+    # Send times of the dance client, every beat or its subdivisions
+    samples = []
+    for start, end in zip(timestamps, timestamps[1:]):
+        samples.extend(
+            start + (end - start) * k / subdivisions for k in range(subdivisions)
+        )
+    return samples + timestamps[-1:]
+
+
+class Cabinet:
+    # One simulated player: picks its dancers from a few prepare frames,
+    # registers, and sends dance frames at the beat times with the same
+    # in-flight cap as the browser, timing every dance_response
+    def __init__(self, url: str, payloads: List[bytes], timeout: float):
+        import socketio
+
+        self.url = url
+        self.payloads = payloads
+        self.timeout = timeout
+        self.client = socketio.Client(reconnection=False)
+        self.lock = threading.Lock()
+        self.prepared = threading.Event()
+        self.finished = threading.Event()
+
+        self.track_ids: List[int] = []
+        self.in_flight: Dict[float, float] = dict()
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.lost = 0
+        self.error: str | None = None
+
+        self.client.on("prepare_response", self.on_prepare, namespace="/dance")
+        self.client.on("dance_response", self.on_dance, namespace="/dance")
+        self.client.on("scores", lambda _: self.finished.set(), namespace="/dance")
+
+    def on_prepare(self, data: bytes):
+        detections = responses.decode_prepare_response(data)
+        self.track_ids = [d["track_id"] for d in detections if "track_id" in d]
+        self.prepared.set()
+
+    def on_dance(self, data: bytes):
+        received = time.perf_counter()
+        response = responses.decode_dance_response(data)
+        with self.lock:
+            sent_at = self.in_flight.pop(response["timestamp"], None)
+            if sent_at is None:
+                return
+            self.latencies.append(received - sent_at)
+            self.dropped += response["dropped"]
+
+    def expire(self, now: float):
+        with self.lock:
+            expired = [t for t, at in self.in_flight.items() if now - at > self.timeout]
+            for t in expired:
+                del self.in_flight[t]
+            self.lost += len(expired)
+
+    def run(
+        self,
+        reference_id: int,
+        samples: List[float],
+        max_in_flight: int,
+        prepare_frames: int,
+    ):
+        try:
+            self.client.connect(
+                self.url, namespaces=["/dance"], wait_timeout=self.timeout
+            )
+            for payload in self.payloads[:prepare_frames]:
+                self.prepared.clear()
+                self.client.emit("prepare", payload, namespace="/dance")
+                self.prepared.wait(self.timeout)
+
+            # Untrained or empty frames find nobody, a made up dancer keeps
+            # the session scoring anyway
+            dancers = [[track_id, None] for track_id in self.track_ids or [1]]
+            self.client.emit("register", (reference_id, dancers), namespace="/dance")
+
+            start = time.perf_counter() - samples[0]
+            for i, timestamp in enumerate(samples):
+                delay = start + timestamp - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                now = time.perf_counter()
+                self.expire(now)
+                with self.lock:
+                    if len(self.in_flight) >= max_in_flight:
+                        self.skipped += 1
+                        continue
+                    self.in_flight[timestamp] = now
+                    self.sent += 1
+                payload = self.payloads[i % len(self.payloads)]
+                self.client.emit(
+                    "dance", stamp_frame(payload, timestamp), namespace="/dance"
+                )
+
+            deadline = time.perf_counter() + self.timeout
+            while self.in_flight and time.perf_counter() < deadline:
+                time.sleep(0.01)
+            self.expire(float("inf"))
+
+            self.client.emit("finished", namespace="/dance")
+            self.finished.wait(self.timeout)
+        except Exception as e:
+            self.error = repr(e)
+        finally:
+            self.client.disconnect()
+
+
+def start_server(port: int) -> Tuple[subprocess.Popen, str]:
+    # Runs main.py in production mode, with its models preloaded
+    root = os.path.dirname(current_app.root_path)
+    log = tempfile.NamedTemporaryFile("w+", suffix=".log", delete=False)
+    env = dict(os.environ, PORT=str(port), PROD="1")
+    # Set by the flask command, it would make Flask-SocketIO serve with
+    # Werkzeug instead of eventlet
+    env.pop("FLASK_RUN_FROM_CLI", None)
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(root, "main.py")],
+        cwd=root,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    return (server, log.name)
+
+
+def wait_for_server(url: str, server: subprocess.Popen | None, timeout: float):
+    import requests
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server is not None and server.poll() is not None:
+            raise click.ClickException("The server exited while starting")
+        try:
+            if requests.get(f"{url}/stats/cache", timeout=1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise click.ClickException(f"No response from {url} after {timeout:.0f}s")
+
+
+def seed_reference(path: str | None, seconds: float) -> int:
+    from flaskr.db import get_db
+    from flaskr.videos import (
+        analyze_beats,
+        get_timeline,
+        save_timeline,
+        upload_reference,
+    )
+
+    # Copies land in the references folder like uploads do, and the content
+    # hash makes reruns reuse the reference seeded before
+    folder = current_app.config["REFERENCES_FOLDER"]
+    if path is None:
+        target = os.path.join(folder, f"bench-load-{seconds:.0f}s.mp4")
+        if not os.path.exists(target):
+            write_synthetic_song(target, seconds)
+    else:
+        target = os.path.join(folder, os.path.basename(path))
+        if not os.path.exists(target):
+            shutil.copy(path, target)
+
+    reference_id = upload_reference(target, os.path.basename(target))
+    if len(get_timeline(reference_id)) > 0:
+        return reference_id
+    if path is not None:
+        raise click.ClickException(f"Nobody to dance along to was found in {path}")
+
+    # The synthetic song has no dancer, so its beats get a standing pose
+    beats = analyze_beats(target)
+    poses = np.tile(np.array([1.0, 0.5, 0.5], dtype=np.float32), (len(beats), 17, 1))
+    db = get_db()
+    save_timeline(db.cursor(), reference_id, beats, poses)
+    db.commit()
+    cache.invalidate_reference(reference_id)
+    return reference_id
+
+
+@click.command("bench-load")
+@click.option("--url", help="Server to load, main.py is started locally if unset")
+@click.option("--port", default=5050, help="Port of the local server")
+@click.option("--video", help="Reference video to seed, a synthetic song if unset")
+@click.option("--frames", "frames_path", help="Recorded dancer video to replay")
+@click.option(
+    "--cabinets",
+    "levels",
+    multiple=True,
+    type=int,
+    default=(1, 2, 4),
+    help="Concurrent sessions, once per level",
+)
+@click.option("--seconds", default=30.0, help="Length of the dance replayed")
+@click.option("--subdivisions", default=1, help="Frames per beat, 4 for window mode")
+@click.option("--width", default=640, help="Width of the frames sent")
+@click.option("--quality", default=80, help="JPEG quality of the frames sent")
+@click.option("--max-in-flight", default=2)
+@click.option("--prepare", "prepare_frames", default=3)
+@click.option("--stagger", default=0.05, help="Seconds between cabinet starts")
+@click.option("--target", default=250.0, help="p95 latency in ms a level must meet")
+@click.option("--max-drop", default=0.05, help="Fraction of frames a level may lose")
+@click.option("--cores", type=int, help="Server cores, this machine's if unset")
+@click.option("--timeout", default=10.0)
+def bench_load_command(
+    url,
+    port,
+    video,
+    frames_path,
+    levels,
+    seconds,
+    subdivisions,
+    width,
+    quality,
+    max_in_flight,
+    prepare_frames,
+    stagger,
+    target,
+    max_drop,
+    cores,
+    timeout,
+):
+    import requests
+
+    reference_id = seed_reference(video, seconds + 5)
+
+    if frames_path is None:
+        images = [synthetic_frame(width, width * 3 // 4, seed) for seed in range(8)]
+    else:
+        images = read_frames(frames_path, 300)
+    payloads = []
+    for image in images:
+        (height, w) = image.shape[:2]
+        image = cv2.resize(image, (width, round(height * width / w)))
+        payloads.append(frames.encode_frame(image, frames.FORMAT_JPEG, 0.0, quality))
+
+    server = None
+    if url is None:
+        url = f"http://127.0.0.1:{port}"
+        (server, log) = start_server(port)
+        click.echo(f"Started the server on {url}, logging to {log}")
+    try:
+        wait_for_server(url, server, 600)
+
+        timeline = requests.get(f"{url}/reference/{reference_id}/steps").json()
+        beats = [t for t, _pose in timeline if t <= timeline[0][0] + seconds]
+        samples = sample_times(beats, subdivisions)
+
+        cores = cores or len(os.sched_getaffinity(0))
+        click.echo(
+            f"Reference {reference_id}: {len(samples)} frames over "
+            f"{samples[-1] - samples[0]:.1f}s, {len(payloads[0])} bytes each"
+        )
+        click.echo(
+            f"{'cabinets':>8} {'sent':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+            f" {'dropped':>8} {'skipped':>8} {'lost':>6} {'fps':>7}"
+        )
+
+        sustained = 0
+        for level in levels:
+            cabinets = [Cabinet(url, payloads, timeout) for _ in range(level)]
+            threads = []
+            started = time.perf_counter()
+            for cabinet in cabinets:
+                thread = threading.Thread(
+                    target=cabinet.run,
+                    args=(reference_id, samples, max_in_flight, prepare_frames),
+                )
+                thread.start()
+                threads.append(thread)
+                time.sleep(stagger)
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            for cabinet in cabinets:
+                if cabinet.error is not None:
+                    click.echo(f"Cabinet failed: {cabinet.error}")
+            latencies = np.array([t for c in cabinets for t in c.latencies]) * 1000
+            sent = sum(c.sent for c in cabinets)
+            dropped = sum(c.dropped for c in cabinets)
+            skipped = sum(c.skipped for c in cabinets)
+            lost = sum(c.lost for c in cabinets)
+            (p50, p95, p99) = (
+                np.percentile(latencies, [50, 95, 99])
+                if len(latencies)
+                else [np.nan] * 3
+            )
+            click.echo(
+                f"{level:>8} {sent:>6} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}"
+                f" {dropped:>8} {skipped:>8} {lost:>6} {len(latencies) / elapsed:>7.1f}"
+            )
+
+            # Server drops, client skips and lost frames all go unscored
+            expected = level * len(samples)
+            unscored = (dropped + skipped + lost) / max(expected, 1)
+            if (
+                p95 <= target
+                and unscored <= max_drop
+                and not any(c.error for c in cabinets)
+            ):
+                sustained = max(sustained, level)
+
+        click.echo(
+            f"Sustained {sustained} session(s) within {target:.0f} ms p95 and "
+            f"{max_drop:.0%} unscored frames, {sustained / cores:.2f} per core "
+            f"on {cores} core(s)"
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def legacy_dance_response(
+    result: responses.DanceResult,
+    step: np.ndarray,
+    timestamp: float,
+    latency: float,
+    queue: int,
+) -> dict:
+    # The dance_response dict emitted before the binary format
+    dancers = dict()
+    for track_id, pose, score, current_score in zip(
+        result.track_ids, result.poses, result.scores, result.current_scores
+    ):
+        dancers[track_id] = {
+            "pose": pose.tolist(),
+            "score": float(score),
+            "currentScore": float(current_score),
+        }
+    return {
+        "dropped": False,
+        "step": step.tolist(),
+        "dancers": dancers,
+        "timestamp": timestamp,
+        "latency": latency,
+        "queue": queue,
+    }
+
+
+def synthetic_result(dancers: int, seed=0) -> "Results":
+    import torch
+    from ultralytics.engine.results import Results
+
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 320, (dancers, 2))
+    sizes = rng.uniform(80, 320, (dancers, 2))
+    # x1, y1, x2, y2, track id, confidence, class
+    boxes = np.column_stack(
+        [
+            corners,
+            corners + sizes,
+            np.arange(1, dancers + 1),
+            rng.uniform(0.5, 1, dancers),
+            np.zeros(dancers),
+        ]
+    )
+    keypoints = np.empty((dancers, 17, 3))
+    keypoints[..., :2] = (
+        corners[:, None] + rng.random((dancers, 17, 2)) * sizes[:, None]
+    )
+    keypoints[..., 2] = rng.random((dancers, 17))
+
+    return Results(
+        np.zeros((480, 640, 3), dtype=np.uint8),
+        "",
+        {0: "person"},
+        boxes=torch.tensor(boxes, dtype=torch.float32),
+        keypoints=torch.tensor(keypoints, dtype=torch.float32),
+    )
+
+
+@click.command("bench-responses")
+@click.option("--dancers", default=4, help="Tracked dancers per frame")
+@click.option("--iterations", default=2000)
+def bench_responses_command(dancers, iterations):
+    from socketio.packet import EVENT, Packet
+
+    rng = np.random.default_rng(0)
+    (timestamp, latency, queue) = (12.345678, 0.0421, 1)
+    step = synthetic_dance(np.array([timestamp]))[0, 0]
+    poses = synthetic_dance(np.array([timestamp]), dancers)[:, 0]
+    poses[..., 1:] += rng.normal(0, 0.05, (dancers, 17, 2))
+    result = responses.DanceResult(
+        False,
+        42,
+        list(range(1, dancers + 1)),
+        poses,
+        rng.uniform(0, 100, dancers),
+        rng.uniform(0, 100, dancers),
+    )
+    prepared = synthetic_result(dancers)
+
+    def packet(payload) -> List[str | bytes]:
+        # The Socket.IO packet as sent, binary payloads go as attachments
+        encoded = Packet(EVENT, ["response", payload], namespace="/dance").encode()
+        return encoded if isinstance(encoded, list) else [encoded]
+
+    def size(encoded: List[str | bytes]) -> int:
+        return sum(len(p.encode() if isinstance(p, str) else p) for p in encoded)
+
+    cases = [
+        (
+            "dance json",
+            lambda: packet(
+                legacy_dance_response(result, step, timestamp, latency, queue)
+            ),
+            lambda encoded: json.loads(encoded[0][encoded[0].index("[") :]),
+        ),
+        (
+            "dance binary",
+            lambda: packet(
+                responses.encode_dance_response(result, timestamp, latency, queue)
+            ),
+            lambda encoded: responses.decode_dance_response(encoded[1]),
+        ),
+        (
+            "prepare json",
+            lambda: packet(prepared.to_json()),
+            lambda encoded: json.loads(
+                json.loads(encoded[0][encoded[0].index("[") :])[1]
+            ),
+        ),
+        (
+            "prepare binary",
+            lambda: packet(responses.encode_prepare_response(prepared)),
+            lambda encoded: responses.decode_prepare_response(encoded[1]),
+        ),
+    ]
+
+    decoded = responses.decode_dance_response(
+        responses.encode_dance_response(result, timestamp, latency, queue)
+    )
+    error = np.abs(
+        np.stack([d["pose"] for d in decoded["dancers"].values()]) - poses
+    ).max()
+    click.echo(f"{dancers} dancers, max keypoint error {error:.2e}")
+    click.echo(
+        f"{'format':<16} {'bytes/frame':>12} {'encode us':>10} {'decode us':>10}"
+    )
+    for name, encode, decode in cases:
+        encoded = encode()
+        encode_time = timed(encode, iterations)
+        decode_time = timed(lambda: decode(encoded), iterations)
+        click.echo(
+            f"{name:<16} {size(encoded):>12} {encode_time * 1e6:>10.1f}"
+            f" {decode_time * 1e6:>10.1f}"
+        )
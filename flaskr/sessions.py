@@ -0,0 +1,151 @@
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from numpy._typing import NDArray
+
+from flaskr.metrics import Sample
+from steps.timeline import StepTimeline
+from steps.video import RegionOfInterest, create_tracker
+
+
+class DanceSession:
+    __slots__ = (
+        "sid",
+        "tracker",
+        "roi",
+        "frame_size",
+        "timeline",
+        "scored",
+        "reference_id",
+        "session_id",
+        "track_slots",
+        "dancer_ids",
+        "scores",
+        "frames",
+        "pending",
+        "latest_timestamp",
+        "latency",
+        "dropped",
+        "history_timestamps",
+        "history_poses",
+        "history_visible",
+        "last_seen",
+    )
+
+    def __init__(self, sid: str, tracker_config: str, roi: RegionOfInterest):
+        self.sid = sid
+        self.tracker = create_tracker(tracker_config)
+        self.roi = roi
+        self.frame_size: Tuple[int, int] | None = None
+        self.timeline = StepTimeline(np.zeros(0), np.zeros((0, 17, 3)))
+        self.scored = np.zeros(0, dtype=np.bool_)
+        self.reference_id: int | None = None
+        self.session_id: int | None = None
+        self.track_slots: Dict[int, int] = dict()
+        self.dancer_ids = np.zeros(0, dtype=np.int64)
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.frames = 0
+        self.pending = 0
+        self.latest_timestamp = float("-inf")
+        self.latency = 0.0
+        self.dropped = 0
+        self.history_timestamps = np.zeros(0, dtype=np.float64)
+        self.history_poses = np.zeros((0, 0, 17, 3), dtype=np.float32)
+        self.history_visible = np.zeros((0, 0), dtype=np.bool_)
+        self.last_seen = time.monotonic()
+
+    def register(self, reference_id: int, timeline: StepTimeline, track_ids: List[int]):
+        # Database ids are filled in by the writer thread once the rows exist
+        self.timeline = timeline
+        self.scored = np.zeros(len(timeline), dtype=np.bool_)
+        self.reference_id = reference_id
+        self.session_id = None
+        self.track_slots = {track_id: i for i, track_id in enumerate(track_ids)}
+        self.dancer_ids = np.zeros(len(track_ids), dtype=np.int64)
+        self.scores = np.zeros(len(track_ids), dtype=np.float64)
+        self.frames = 0
+        self.latest_timestamp = float("-inf")
+        self.dropped = 0
+        self.history_timestamps = np.zeros(0, dtype=np.float64)
+        self.history_poses = np.zeros((len(track_ids), 0, 17, 3), dtype=np.float32)
+        self.history_visible = np.zeros((len(track_ids), 0), dtype=np.bool_)
+
+    def push_history(
+        self, timestamp: float, poses: NDArray, visible: NDArray, keep: float
+    ):
+        # Live poses of every dancer slot (dancers x 17 x 3) for windowed
+        # scoring, samples older than `keep` seconds are dropped
+        recent = self.history_timestamps >= timestamp - keep
+        self.history_timestamps = np.append(self.history_timestamps[recent], timestamp)
+        self.history_poses = np.concatenate(
+            [self.history_poses[:, recent], poses[:, None]], axis=1
+        )
+        self.history_visible = np.concatenate(
+            [self.history_visible[:, recent], visible[:, None]], axis=1
+        )
+
+    def update_latency(self, latency: float, smoothing=0.2):
+        if self.latency == 0.0:
+            self.latency = latency
+        else:
+            self.latency += smoothing * (latency - self.latency)
+
+
+class SessionRegistry:
+    def __init__(
+        self,
+        tracker_config: str = "botsort.yaml",
+        idle_timeout=600.0,
+        roi_margin=0.15,
+        roi_redetect_interval=15,
+    ):
+        self.tracker_config = tracker_config
+        self.idle_timeout = idle_timeout
+        self.roi_margin = roi_margin
+        self.roi_redetect_interval = roi_redetect_interval
+        self.sessions: Dict[str, DanceSession] = dict()
+        self.lock = threading.Lock()
+
+    def open(self, sid: str) -> DanceSession:
+        roi = RegionOfInterest(self.roi_margin, self.roi_redetect_interval)
+        session = DanceSession(sid, self.tracker_config, roi)
+        with self.lock:
+            self.sessions[sid] = session
+        return session
+
+    def get(self, sid: str) -> DanceSession | None:
+        with self.lock:
+            session = self.sessions.get(sid)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def close(self, sid: str) -> DanceSession | None:
+        with self.lock:
+            return self.sessions.pop(sid, None)
+
+    def evict_idle(self) -> List[str]:
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [s.sid for s in self.sessions.values() if s.last_seen < deadline]
+            for sid in idle:
+                del self.sessions[sid]
+        return idle
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def metrics(self) -> Iterator[Sample]:
+        with self.lock:
+            sessions = list(self.sessions.values())
+
+        yield ("dance_sessions_active", (), float(len(sessions)))
+        registered = sum(s.reference_id is not None for s in sessions)
+        yield ("dance_sessions_registered", (), float(registered))
+        for s in sessions:
+            labels = (("session", s.sid),)
+            yield ("dance_session_latency_seconds", labels, s.latency)
+            yield ("dance_session_pending_frames", labels, float(s.pending))
+            yield ("dance_session_dropped_frames_total", labels, float(s.dropped))
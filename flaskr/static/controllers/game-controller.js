@@ -1,8 +1,5 @@
 /**
  * @typedef {Object} PoseEstimation
- * @property {string} name - The name of the detected object.
- * @property {number} class - The class identifier.
- * @property {number} confidence - The confidence score of the detection.
  * @property {Object} box - The bounding box of the detected object.
  * @property {number} box.x1 - The x-coordinate of the top-left corner of the box.
  * @property {number} box.y1 - The y-coordinate of the top-left corner of the box.
@@ -19,6 +16,14 @@ Stimulus.register(
   "game",
   class extends Controller {
     static FPS = 15;
+    static FRAME_FORMAT = FRAME_JPEG;
+    // Dance frames adapt their size and quality to stay under this round trip
+    static TARGET_LATENCY = 250;
+    static MAX_IN_FLIGHT = 2;
+    static FRAME_TIMEOUT = 2000;
+    static MIN_CAPTURE_SCALE = 0.25;
+    static MIN_QUALITY = 0.5;
+    static MAX_QUALITY = 0.92;
 
     static values = {
       state: { type: String, default: "prepare" },
@@ -39,6 +44,11 @@ Stimulus.register(
       this.dispose = [];
 
       this.canvas = document.createElement("canvas");
+      this.danceCanvas = document.createElement("canvas");
+      this.captureScale = 1;
+      this.quality = this.constructor.MAX_QUALITY;
+      /** @type {Map<number, number>} beat timestamp -> send time */
+      this.inFlight = new Map();
 
       this.debugCanvas = document.createElement("canvas");
       this.debugCanvas.id = "debug-canvas";
@@ -94,7 +104,7 @@ Stimulus.register(
       this.persons = new Map();
 
       this.socket.on("prepare_response", (response) => {
-        const result = JSON.parse(response);
+        const result = decodePrepareResponse(response);
         this.findPlayers(result);
         if (this.isDebug) this.drawResult(result);
         this.sendPrepareFrame();
@@ -137,23 +147,62 @@ Stimulus.register(
       this.stateValue = "dance";
       this.referenceTarget.play();
 
-      let i = 0;
+      if (this.element.dataset.scoringMode === "window") {
+        this.startSampling();
+      } else {
+        let i = 0;
 
-      this.referenceTarget.addEventListener("timeupdate", () => {
-        const currentTime = this.referenceTarget.currentTime;
-        if (i < this.steps.length && currentTime > this.steps[i][0]) {
-          this.sendDanceFrame(this.steps[i][0]);
-          ++i;
-        }
-      });
+        this.referenceTarget.addEventListener("timeupdate", () => {
+          const currentTime = this.referenceTarget.currentTime;
+          if (i < this.steps.length && currentTime > this.steps[i][0]) {
+            this.sendDanceFrame(this.steps[i][0]);
+            ++i;
+          }
+        });
+      }
 
       this.referenceTarget.addEventListener("ended", () => {
         this.showScore();
       });
 
+      this.socket.on("dance_response", (data) => {
+        const response = decodeDanceResponse(data);
+        this.adaptCapture(response);
+        if (this.isDebug && response.step >= 0) this.drawDanceResult(response);
+      });
+
       this.setupReferenceBg();
     }
 
+    /**
+     * Windowed scoring grades frames between beats as well, so frames are
+     * sent at the subdivisions of each beat interval and stamped with the
+     * playback time they were captured at.
+     */
+    startSampling() {
+      const subdivisions = Number(this.element.dataset.scoringSubdivisions);
+      const samples = this.steps.flatMap(([timestamp], i) => {
+        if (i + 1 === this.steps.length) return [timestamp];
+        const next = this.steps[i + 1][0];
+        return [...Array(subdivisions).keys()].map(
+          (k) => timestamp + ((next - timestamp) * k) / subdivisions,
+        );
+      });
+
+      let i = 0;
+      const sample = () => {
+        if (this.stateValue !== "dance") return;
+
+        const currentTime = this.referenceTarget.currentTime;
+        if (i < samples.length && currentTime >= samples[i]) {
+          while (i < samples.length && currentTime >= samples[i]) ++i;
+          this.sendDanceFrame(currentTime);
+        }
+        requestAnimationFrame(sample);
+      };
+      requestAnimationFrame(sample);
+    }
+
     showScore() {
       this.stateValue = "score";
       const dancers = [...this.persons.entries()].filter(
@@ -189,9 +238,9 @@ Stimulus.register(
         this.canvas.width,
         this.canvas.height,
       );
-      const data = this.canvas
-        .toDataURL("image/jpeg")
-        .replace("data:image/jpeg;base64,", "");
+      const data = await encodeFrame(this.canvas, {
+        format: this.constructor.FRAME_FORMAT,
+      });
 
       this.socket.emit("prepare", data);
     }
@@ -199,22 +248,69 @@ Stimulus.register(
     async sendDanceFrame(timestamp) {
       if (this.stateValue !== "dance") return;
 
-      const context = this.canvas.getContext("2d");
-      context.drawImage(
-        this.cameraTarget,
-        0,
-        0,
-        this.canvas.width,
-        this.canvas.height,
-      );
-      const data = this.canvas
-        .toDataURL("image/jpeg")
-        .replace("data:image/jpeg;base64,", "");
-
-      this.socket.on("dance_response", (response) => {
-        if (this.isDebug) this.drawDanceResult(response);
+      // Skip beats while the server is still busy with earlier frames,
+      // sending more would only queue them up behind the music
+      const now = performance.now();
+      this.inFlight.forEach((sentAt, key) => {
+        if (now - sentAt > this.constructor.FRAME_TIMEOUT) {
+          this.inFlight.delete(key);
+        }
+      });
+      if (this.inFlight.size >= this.constructor.MAX_IN_FLIGHT) return;
+      this.inFlight.set(timestamp, now);
+
+      const canvas = this.danceCanvas;
+      canvas.width = Math.round(this.canvas.width * this.captureScale);
+      canvas.height = Math.round(this.canvas.height * this.captureScale);
+
+      const context = canvas.getContext("2d");
+      context.drawImage(this.cameraTarget, 0, 0, canvas.width, canvas.height);
+      const data = await encodeFrame(canvas, {
+        format: this.constructor.FRAME_FORMAT,
+        timestamp: timestamp,
+        quality: this.quality,
       });
-      this.socket.emit("dance", data, timestamp);
+
+      this.socket.emit("dance", data);
+    }
+
+    /**
+     * Lowers JPEG quality first and then the capture resolution while the
+     * round trip is over the target, and recovers slowly once it is well under.
+     * The server scales smaller frames back to the size the session started
+     * with, so its trackers see one resolution throughout.
+     *
+     * @param {{timestamp: number, latency: number, queue: number}} response
+     */
+    adaptCapture(response) {
+      const sentAt = this.inFlight.get(response.timestamp);
+      if (sentAt === undefined) return;
+      this.inFlight.delete(response.timestamp);
+
+      const {
+        TARGET_LATENCY,
+        MIN_CAPTURE_SCALE,
+        MIN_QUALITY,
+        MAX_QUALITY,
+      } = this.constructor;
+      const latency = performance.now() - sentAt;
+
+      if (latency > TARGET_LATENCY || response.queue > 1) {
+        if (this.quality > MIN_QUALITY) {
+          this.quality = Math.max(MIN_QUALITY, this.quality - 0.1);
+        } else {
+          this.captureScale = Math.max(
+            MIN_CAPTURE_SCALE,
+            this.captureScale * 0.8,
+          );
+        }
+      } else if (latency < TARGET_LATENCY * 0.5 && response.queue === 0) {
+        if (this.captureScale < 1) {
+          this.captureScale = Math.min(1, this.captureScale * 1.1);
+        } else {
+          this.quality = Math.min(MAX_QUALITY, this.quality + 0.02);
+        }
+      }
     }
 
     disconnect() {
@@ -287,7 +383,28 @@ Stimulus.register(
         method: "POST",
         body: formData,
       });
-      return (await resp.json()).reference_id;
+      const { job_id } = await resp.json();
+
+      return await this.waitForJob(job_id);
+    }
+
+    async waitForJob(jobId) {
+      while (true) {
+        const resp = await fetch(`/jobs/${jobId}`);
+        const job = await resp.json();
+
+        if (job.status === "done") {
+          return job.reference_id;
+        } else if (job.status === "failed") {
+          console.error("Failed to process video", job.error);
+          Turbo.visit("/", { action: "replace" });
+          return;
+        }
+
+        const percent = Math.round(job.progress * 100);
+        this.setPrepareStatus(`Processing reference video (${percent}%)`, true);
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+      }
     }
 
     handleXPress(event) {
@@ -420,7 +537,7 @@ Stimulus.register(
       context.fillStyle = "white";
       context.fillRect(0, 0, this.debugCanvas.width, this.debugCanvas.height);
 
-      drawStickFigure(context, response.step, 0, "green");
+      drawStickFigure(context, this.steps[response.step][1], 0, "green");
       const dancer = Object.values(response.dancers)[0];
 
       if (dancer) {
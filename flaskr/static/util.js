@@ -136,3 +136,159 @@ function drawStickFigure(ctx, pose, offsetX, color) {
     }
   });
 }
+
+const FRAME_JPEG = 0;
+const FRAME_BGR = 1;
+const FRAME_GRAY = 2;
+const FRAME_HEADER_SIZE = 18;
+
+/**
+ * Packs the canvas into a binary frame, mirrored by flaskr/frames.py:
+ * magic "DTBF", version, format, width, height, timestamp (little endian).
+ *
+ * @param {HTMLCanvasElement} canvas
+ * @returns {Promise<ArrayBuffer>}
+ */
+async function encodeFrame(
+  canvas,
+  { format = FRAME_JPEG, timestamp = 0, quality = 0.92 } = {},
+) {
+  let payload;
+  if (format === FRAME_JPEG) {
+    const blob = await new Promise((resolve) =>
+      canvas.toBlob(resolve, "image/jpeg", quality),
+    );
+    payload = new Uint8Array(await blob.arrayBuffer());
+  } else {
+    const context = canvas.getContext("2d");
+    const rgba = context.getImageData(0, 0, canvas.width, canvas.height).data;
+    const channels = format === FRAME_GRAY ? 1 : 3;
+    payload = new Uint8Array((rgba.length / 4) * channels);
+
+    for (let i = 0, j = 0; i < rgba.length; i += 4, j += channels) {
+      if (format === FRAME_GRAY) {
+        payload[j] =
+          0.299 * rgba[i] + 0.587 * rgba[i + 1] + 0.114 * rgba[i + 2];
+      } else {
+        payload[j] = rgba[i + 2];
+        payload[j + 1] = rgba[i + 1];
+        payload[j + 2] = rgba[i];
+      }
+    }
+  }
+
+  const buffer = new ArrayBuffer(FRAME_HEADER_SIZE + payload.length);
+  const header = new DataView(buffer);
+  "DTBF".split("").forEach((c, i) => header.setUint8(i, c.charCodeAt(0)));
+  header.setUint8(4, 1);
+  header.setUint8(5, format);
+  header.setUint16(6, canvas.width, true);
+  header.setUint16(8, canvas.height, true);
+  header.setFloat64(10, timestamp, true);
+  new Uint8Array(buffer, FRAME_HEADER_SIZE).set(payload);
+
+  return buffer;
+}
+
+const DANCE_HEADER_SIZE = 32;
+const PREPARE_HEADER_SIZE = 8;
+const COORDINATE_SCALE = 8192;
+const CONFIDENCE_SCALE = 255;
+
+function checkMagic(view, magic) {
+  const found = String.fromCharCode(
+    ...new Uint8Array(view.buffer, view.byteOffset, 4),
+  );
+  if (found !== magic || view.getUint8(4) !== 1) {
+    throw new Error(`Not a ${magic} response`);
+  }
+}
+
+/**
+ * Unpacks a dance_response, mirrored by flaskr/responses.py: magic "DTBR",
+ * version, flags, dancers, queue, step index, timestamp, latency, then the
+ * track ids, scores, current scores and quantized [confidence, x, y] poses.
+ * The step comes back as its index into the fetched steps, -1 for none.
+ *
+ * @param {ArrayBuffer} buffer
+ */
+function decodeDanceResponse(buffer) {
+  const view = new DataView(buffer);
+  checkMagic(view, "DTBR");
+
+  const count = view.getUint16(6, true);
+  let offset = DANCE_HEADER_SIZE;
+  const trackIds = new Int32Array(buffer, offset, count);
+  offset += 4 * count;
+  const scores = new Float32Array(buffer, offset, count);
+  offset += 4 * count;
+  const currentScores = new Float32Array(buffer, offset, count);
+  offset += 4 * count;
+  const coordinates = new Int16Array(buffer, offset, count * 17 * 2);
+  offset += 68 * count;
+  const confidences = new Uint8Array(buffer, offset, count * 17);
+
+  const dancers = {};
+  trackIds.forEach((trackId, i) => {
+    dancers[trackId] = {
+      pose: [...Array(17).keys()].map((k) => [
+        confidences[i * 17 + k] / CONFIDENCE_SCALE,
+        coordinates[(i * 17 + k) * 2] / COORDINATE_SCALE,
+        coordinates[(i * 17 + k) * 2 + 1] / COORDINATE_SCALE,
+      ]),
+      score: scores[i],
+      currentScore: currentScores[i],
+    };
+  });
+
+  return {
+    dropped: (view.getUint8(5) & 1) === 1,
+    step: view.getInt32(12, true),
+    timestamp: view.getFloat64(16, true),
+    latency: view.getFloat32(24, true),
+    queue: view.getUint16(8, true),
+    dancers,
+  };
+}
+
+/**
+ * Unpacks a prepare_response into the detections summary the pose model
+ * used to send as JSON: magic "DTBP", version, detections, then the track
+ * ids (-1 when untracked), pixel boxes, pixel keypoints and visibilities.
+ *
+ * @param {ArrayBuffer} buffer
+ * @returns {PoseEstimation[]}
+ */
+function decodePrepareResponse(buffer) {
+  const view = new DataView(buffer);
+  checkMagic(view, "DTBP");
+
+  const count = view.getUint16(6, true);
+  let offset = PREPARE_HEADER_SIZE;
+  const trackIds = new Int32Array(buffer, offset, count);
+  offset += 4 * count;
+  const boxes = new Uint16Array(buffer, offset, count * 4);
+  offset += 8 * count;
+  const keypoints = new Uint16Array(buffer, offset, count * 17 * 2);
+  offset += 68 * count;
+  const visible = new Uint8Array(buffer, offset, count * 17);
+
+  return [...trackIds].map((trackId, i) => {
+    const points = [...Array(17).keys()].map((k) => (i * 17 + k) * 2);
+    const detection = {
+      box: {
+        x1: boxes[i * 4],
+        y1: boxes[i * 4 + 1],
+        x2: boxes[i * 4 + 2],
+        y2: boxes[i * 4 + 3],
+      },
+      keypoints: {
+        x: points.map((p) => keypoints[p]),
+        y: points.map((p) => keypoints[p + 1]),
+        visible: points.map((p) => visible[p / 2] / CONFIDENCE_SCALE),
+      },
+    };
+    if (trackId >= 0) detection.track_id = trackId;
+    return detection;
+  });
+}
@@ -1,70 +1,302 @@
-import json
+import hashlib
 import os
+import sqlite3
+import time
+from typing import Callable, Dict, Generator, Iterable, NamedTuple, Tuple
 
 import cv2
+import numpy as np
+from cv2.typing import MatLike
 from flask import current_app
-from ultralytics import YOLO
+from numpy._typing import NDArray
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
 import steps
+from flaskr import cache, metrics
 from flaskr.db import get_db
+from flaskr.pose import get_pool
+from steps.timeline import StepTimeline
 
+# Bump when a change to the pipeline makes cached analysis results stale
+BEATS_VERSION = 1
+POSES_VERSION = 1
 
-def save_video(file: FileStorage):
+
+def save_video(file: FileStorage) -> str | None:
     if not file.filename or not file.filename.endswith(".mp4"):
         return None
 
     filename = secure_filename(file.filename)
     path = os.path.join(current_app.config["REFERENCES_FOLDER"], filename)
     file.save(path)
-    return upload_reference(path, file.filename)
+    return path
+
+
+def no_progress(_stage: str, _progress: float):
+    pass
+
+
+def report_progress(
+    frames: Iterable[MatLike], total: int, progress: Callable[[str, float], None]
+) -> Generator[MatLike, None, None]:
+    every = current_app.config["INGEST_BATCH_SIZE"]
+    for i, frame in enumerate(frames):
+        if i % every == 0:
+            progress("poses", 0.1 + 0.8 * i / max(total, 1))
+        yield frame
+
+
+class ProcessedReference(NamedTuple):
+    timestamps: NDArray
+    poses: NDArray
+    thumbnail: bytes | None
+    timings: Dict[str, float]
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def upload_reference(path: str, filename: str, selection=False):
-    with open(path, "rb") as video:
-        (_tempo, beats, _y, _sr) = steps.music.analyze_audio(video)
+def find_reference(content_hash: str) -> int | None:
+    result = (
+        get_db()
+        .execute(
+            'SELECT reference_id FROM "References" WHERE content_hash = ?',
+            (content_hash,),
+        )
+        .fetchone()
+    )
+    return None if result is None else result[0]
+
+
+def analyze_beats(path: str, content_hash: str | None = None) -> NDArray:
+    analysis_cache = cache.get_analysis_cache()
+    key = analysis_cache.key(
+        content_hash or file_hash(path),
+        "beats",
+        BEATS_VERSION,
+        steps.music.BEAT_SAMPLE_RATE,
+    )
+
+    cached = analysis_cache.load(key)
+    if cached is not None:
+        return cached["beats"]
 
-    model_config = current_app.config["POSE_MODEL"] or "yolo11n-pose.pt"
-    model = YOLO(model_config)
+    (_tempo, beats) = steps.music.analyze_audio(path)
+    analysis_cache.save(key, beats=beats)
+    return beats
 
-    frames = steps.video.get_frames(path, beats) or []
-    result = steps.video.get_main_pose(model, frames, beats)
 
-    if len(frames) == 0:
+def pose_cache_key(content_hash: str) -> str:
+    # Every setting that changes the extracted poses is part of the key
+    config = current_app.config
+    return cache.DiskCache.key(
+        content_hash,
+        "poses",
+        POSES_VERSION,
+        config["POSE_MODEL"],
+        config["POSE_BACKEND"],
+        config["INFERENCE_IMGSZ"],
+        sorted(steps.video.tracker_settings(config["POSE_TRACKER"]).items()),
+        config["INGEST_FRAME_SIZE"],
+    )
+
+
+def get_cached_poses(content_hash: str) -> Tuple[NDArray, NDArray] | None:
+    cached = cache.get_analysis_cache().load(pose_cache_key(content_hash))
+    if cached is None:
+        return None
+    return (cached["timestamps"], cached["poses"])
+
+
+def process_reference(
+    path: str,
+    progress: Callable[[str, float], None] = no_progress,
+    content_hash: str | None = None,
+) -> ProcessedReference:
+    if content_hash is None:
+        content_hash = file_hash(path)
+
+    timings = dict()
+    start = time.perf_counter()
+
+    progress("audio", 0.0)
+    beats = analyze_beats(path, content_hash)
+    timings["audio"] = time.perf_counter() - start
+
+    cached = get_cached_poses(content_hash)
+    if cached is None:
+        frames = steps.video.iter_frames(
+            path, beats, current_app.config["INGEST_FRAME_SIZE"]
+        )
+        with get_pool().checkout() as model:
+            (timestamps, poses) = steps.video.get_main_pose(
+                model,
+                report_progress(frames, len(beats), progress),
+                beats,
+                current_app.config["INGEST_BATCH_SIZE"],
+                steps.video.create_tracker(current_app.config["POSE_TRACKER"]),
+            )
+        cache.get_analysis_cache().save(
+            pose_cache_key(content_hash), timestamps=timestamps, poses=poses
+        )
+    else:
+        (timestamps, poses) = cached
+    timings["poses"] = time.perf_counter() - start - timings["audio"]
+
+    progress("saving", 0.9)
+
+    first_frame = next(steps.video.iter_frames(path, beats[:1]), None)
+    if first_frame is None:
         thumbnail = None
     else:
-        _, buffer = cv2.imencode(".jpg", frames[0])
+        _, buffer = cv2.imencode(".jpg", first_frame)
         thumbnail = buffer.tobytes()
+    timings["thumbnail"] = time.perf_counter() - start - sum(timings.values())
 
-    title = filename.replace(".mp4", "")
+    return ProcessedReference(timestamps, poses, thumbnail, timings)
 
-    db = get_db()
-    cursor = db.cursor()
+
+def store_reference(
+    cursor: sqlite3.Cursor,
+    path: str,
+    filename: str,
+    selection: bool,
+    content_hash: str | None,
+    processed: ProcessedReference,
+) -> int:
+    title = filename.replace(".mp4", "")
 
     cursor.execute(
-        'INSERT INTO "References" (filepath, title, selected, thumbnail) VALUES (?, ?, ?, ?)',
-        (path, title, selection, thumbnail),
+        'INSERT INTO "References" (filepath, title, selected, thumbnail, content_hash) VALUES (?, ?, ?, ?, ?)',
+        (path, title, selection, processed.thumbnail, content_hash),
     )
 
     reference_id = cursor.lastrowid
+    assert reference_id is not None
 
-    cursor.executemany(
-        "INSERT INTO Steps (reference_id, timestamp, pose) VALUES (?, ?, ?)",
-        [(reference_id, res[0], json.dumps(res[1])) for res in result],
-    )
+    save_timeline(cursor, reference_id, processed.timestamps, processed.poses)
+    return reference_id
+
+
+def upload_reference(
+    path: str,
+    filename: str,
+    selection=False,
+    progress: Callable[[str, float], None] = no_progress,
+):
+    with metrics.ingest_timer("hash"):
+        content_hash = file_hash(path)
+    reference_id = find_reference(content_hash)
+    if reference_id is not None:
+        return reference_id
 
-    db.commit()
+    processed = process_reference(path, progress, content_hash)
+    metrics.observe_ingest(processed.timings)
+
+    with metrics.ingest_timer("store"):
+        db = get_db()
+        reference_id = store_reference(
+            db.cursor(), path, filename, selection, content_hash, processed
+        )
+        db.commit()
+    cache.invalidate_reference(reference_id)
 
     return reference_id
 
 
+def save_timeline(
+    cursor: sqlite3.Cursor, reference_id: int, timestamps: NDArray, poses: NDArray
+):
+    cursor.execute(
+        'INSERT OR REPLACE INTO "Timelines" (reference_id, timestamps, poses) VALUES (?, ?, ?)',
+        (
+            reference_id,
+            timestamps.astype("<f8").tobytes(),
+            poses.astype("<f4").tobytes(),
+        ),
+    )
+
+
+def get_timeline(reference_id: int) -> StepTimeline:
+    timeline = cache.timelines.get(reference_id)
+    if timeline is not None:
+        return timeline
+
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(
+        'SELECT timestamps, poses FROM "Timelines" WHERE reference_id = ?',
+        (reference_id,),
+    )
+    result = cursor.fetchone()
+    if result is None:
+        return StepTimeline(np.zeros(0), np.zeros((0, 17, 3), dtype=np.float32))
+
+    timestamps = np.frombuffer(result[0], dtype="<f8")
+    poses = np.frombuffer(result[1], dtype="<f4").reshape(-1, 17, 3)
+    timeline = StepTimeline(timestamps, poses)
+
+    cache.timelines.put(
+        reference_id, timeline, timeline.timestamps.nbytes + timeline.poses.nbytes
+    )
+    return timeline
+
+
 def get_steps(reference_id: int):
+    timeline = get_timeline(reference_id)
+    return list(zip(timeline.timestamps.tolist(), timeline.poses.tolist()))
+
+
+class Thumbnail(NamedTuple):
+    data: bytes
+    etag: str
+
+
+def get_thumbnail(reference_id: int) -> Thumbnail | None:
+    thumbnail = cache.thumbnails.get(reference_id)
+    if thumbnail is not None:
+        return thumbnail
+
     db = get_db()
     cursor = db.cursor()
     cursor.execute(
-        "SELECT timestamp, pose FROM Steps WHERE reference_id = ? ORDER BY timestamp ASC",
+        'SELECT thumbnail FROM "References" WHERE reference_id = ?', (reference_id,)
+    )
+    result = cursor.fetchone()
+    if result is None or result[0] is None:
+        return None
+
+    thumbnail = Thumbnail(result[0], hashlib.sha1(result[0]).hexdigest())
+    cache.thumbnails.put(reference_id, thumbnail, len(thumbnail.data))
+    return thumbnail
+
+
+class ReferenceFile(NamedTuple):
+    path: str
+    content_hash: str | None
+
+
+def get_reference_file(reference_id: int) -> ReferenceFile | None:
+    reference_file = cache.files.get(reference_id)
+    if reference_file is not None:
+        return reference_file
+
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(
+        'SELECT filepath, content_hash FROM "References" WHERE reference_id = ?',
         (reference_id,),
     )
-    result = cursor.fetchall()
-    return [(r[0], json.loads(r[1])) for r in result]
+    result = cursor.fetchone()
+    if result is None:
+        return None
+
+    reference_file = ReferenceFile(result[0], result[1])
+    cache.files.put(reference_id, reference_file, len(reference_file.path) + 64)
+    return reference_file
@@ -0,0 +1,199 @@
+import multiprocessing
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List
+
+from flask import Flask, current_app
+
+from flaskr import create_app, metrics, pose
+from flaskr.db import get_db
+from flaskr.videos import ProcessedReference, process_reference, upload_reference
+
+JOB_FIELDS = "job_id, filename, status, stage, progress, reference_id, error, created_at, updated_at"
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+# Set in each worker process by init_worker
+_worker_app: Flask | None = None
+
+
+def init_worker(threads: int | None = None):
+    global _worker_app
+
+    # Keeps parallel workers from oversubscribing the cores between them
+    if threads is not None:
+        import torch
+
+        torch.set_num_threads(threads)
+
+    # A worker runs one job at a time, so one model is all it needs
+    _worker_app = create_app()
+    _worker_app.config["POSE_MODEL_POOL_SIZE"] = 1
+    if threads is not None:
+        # ONNX Runtime and OpenVINO take their thread count from the config
+        _worker_app.config["POSE_THREADS"] = threads
+    pose.preload(_worker_app)
+
+
+def process_file(path: str, content_hash: str) -> ProcessedReference:
+    assert _worker_app is not None
+    with _worker_app.app_context():
+        return process_reference(path, content_hash=content_hash)
+
+
+def run_job(job_id: int):
+    assert _worker_app is not None
+    with _worker_app.app_context():
+        db = get_db()
+        job = db.execute(
+            'SELECT filepath, filename, selected FROM "Jobs" WHERE job_id = ?',
+            (job_id,),
+        ).fetchone()
+
+        def progress(stage: str, value: float):
+            db.execute(
+                'UPDATE "Jobs" SET status = ?, stage = ?, progress = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?',
+                ("running", stage, value, job_id),
+            )
+            db.commit()
+
+        try:
+            reference_id = upload_reference(
+                job["filepath"], job["filename"], bool(job["selected"]), progress
+            )
+        except Exception:
+            db.rollback()
+            fail_job(db, job_id, traceback.format_exc())
+            raise
+
+        db.execute(
+            'UPDATE "Jobs" SET status = ?, stage = NULL, progress = 1, reference_id = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?',
+            ("done", reference_id, job_id),
+        )
+        db.commit()
+
+    # Ingestion timers recorded in this worker are merged by the web server
+    return (reference_id, metrics.drain())
+
+
+def fail_job(db: sqlite3.Connection, job_id: int, error: str):
+    db.execute(
+        'UPDATE "Jobs" SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ? AND status NOT IN (?, ?)',
+        ("failed", error, job_id, "done", "failed"),
+    )
+    db.commit()
+
+
+def create_executor(app: Flask) -> ProcessPoolExecutor:
+    # Workers load torch and their own model, so they are spawned fresh
+    # instead of forked from the web server
+    return ProcessPoolExecutor(
+        max_workers=app.config["INGEST_WORKERS"],
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+    )
+
+
+def start(app: Flask):
+    # Called once when the server starts, so jobs left over from a previous
+    # run start again without waiting for the next upload
+    global _executor
+
+    with app.app_context(), _executor_lock:
+        if _executor is not None:
+            return
+        _executor = create_executor(app)
+
+        # A database that is not initialized or migrated yet has no jobs to
+        # resume, the server still starts so init-db and migrate-db can run
+        try:
+            pending = get_db().execute(
+                'SELECT job_id FROM "Jobs" WHERE status IN (?, ?) ORDER BY job_id',
+                ("queued", "running"),
+            )
+        except sqlite3.OperationalError as e:
+            print(f"Not resuming ingestion jobs: {e}")
+            return
+        for job in pending.fetchall():
+            dispatch(_executor, job["job_id"])
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = create_executor(current_app)
+        return _executor
+
+
+def dispatch(executor: ProcessPoolExecutor, job_id: int):
+    database = current_app.config["DATABASE"]
+
+    def on_done(future: Future):
+        # Failures inside upload_reference are recorded by the worker itself
+        # with their traceback, this catches workers that died before they could
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            db = sqlite3.connect(database)
+            try:
+                fail_job(db, job_id, repr(error))
+            finally:
+                db.close()
+        if error is not None:
+            return
+
+        (_reference_id, samples) = future.result()
+        metrics.merge(samples)
+
+    executor.submit(run_job, job_id).add_done_callback(on_done)
+
+
+def submit_job(path: str, filename: str, selection=False) -> int:
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(
+        'INSERT INTO "Jobs" (filepath, filename, selected, status) VALUES (?, ?, ?, ?)',
+        (path, filename, selection, "queued"),
+    )
+    job_id = cursor.lastrowid
+    db.commit()
+    assert job_id is not None
+
+    dispatch(get_executor(), job_id)
+
+    return job_id
+
+
+def job_to_dict(job: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "job_id": job["job_id"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "reference_id": job["reference_id"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+def get_job(job_id: int) -> Dict[str, Any] | None:
+    job = (
+        get_db()
+        .execute(f'SELECT {JOB_FIELDS} FROM "Jobs" WHERE job_id = ?', (job_id,))
+        .fetchone()
+    )
+    return None if job is None else job_to_dict(job)
+
+
+def get_jobs(limit=50) -> List[Dict[str, Any]]:
+    jobs = get_db().execute(
+        f'SELECT {JOB_FIELDS} FROM "Jobs" ORDER BY job_id DESC LIMIT ?', (limit,)
+    )
+    return [job_to_dict(job) for job in jobs.fetchall()]
@@ -2,11 +2,20 @@
 
 from webassets.env import os
 
-from flaskr import create_app, socketio
+from flaskr import create_app, pose, socketio
+from flaskr.videos import jobs
 
 app = create_app()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     prod = bool(os.environ.get("PROD", False))
+
+    # The reloader runs this script twice, only the serving child needs models
+    # and resumes the ingestion jobs
+    if prod or os.environ.get("WERKZEUG_RUN_MAIN"):
+        jobs.start(app)
+        if app.config["POSE_MODEL_PRELOAD"]:
+            pose.preload(app)
+
     socketio.run(app, debug=not prod, port=port)
@@ -1 +1,11 @@
-from steps import music, video
+import importlib
+
+# The submodules pull in librosa, torch and ultralytics, so each one is only
+# imported the first time it is used as steps.music, steps.video, ...
+__all__ = ["music", "timeline", "video"]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f"steps.{name}")
+    raise AttributeError(f"module 'steps' has no attribute {name!r}")
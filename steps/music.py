@@ -1,31 +1,67 @@
-import io
-from typing import IO
+import threading
+from typing import List
 
 import ffmpeg
 import librosa
-import matplotlib.pyplot as plt
+import numpy as np
+from numpy._typing import NDArray
 
+BEAT_SAMPLE_RATE = 22050
 
-def analyze_audio(video_file: IO[bytes]):
-    out, _ = (
-        ffmpeg.input("pipe:0")
-        .output("pipe:1", format="wav", acodec="pcm_s16le", ar="44100")
-        .run(input=video_file.read(), capture_stdout=True, capture_stderr=True)
+
+def load_audio(path: str, sr=BEAT_SAMPLE_RATE) -> NDArray:
+    # ffmpeg reads the file itself and streams mono float32 samples straight
+    # into a numpy buffer, so neither the video nor a WAV copy is held in memory
+    process = (
+        ffmpeg.input(path)
+        .output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .global_args("-loglevel", "error", "-nostats")
+        .run_async(pipe_stdout=True, pipe_stderr=True)
     )
 
-    audio_bytes = io.BytesIO(out)
-    audio_bytes.seek(0)
+    # stderr is drained alongside, a damaged input can log more than the pipe
+    # holds and block ffmpeg before stdout reaches its end
+    errors: List[bytes] = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+    reader.start()
+
+    buffer = np.empty(sr * 60, dtype=np.float32)
+    size = 0
+    while True:
+        if size == buffer.nbytes:
+            grown = np.empty(len(buffer) * 2, dtype=np.float32)
+            grown[: len(buffer)] = buffer
+            buffer = grown
+
+        read = process.stdout.readinto(memoryview(buffer).cast("B")[size:])
+        if not read:
+            break
+        size += read
+
+    reader.join()
+    if process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, b"".join(errors))
+
+    return buffer[: size // 4].copy()
+
+
+def analyze_audio(path: str, waveform=False):
+    y = load_audio(path)
+    sr = BEAT_SAMPLE_RATE
 
-    y, sr = librosa.load(audio_bytes, sr=None)
     tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
     beat_times = librosa.frames_to_time(beat_frames, sr=sr)
 
-    return (tempo, beat_times, y, sr)
+    if waveform:
+        return (tempo, beat_times, y, sr)
+    return (tempo, beat_times)
 
 
 def plot_beats(path: str):
-    with open(path, "rb") as file:
-        tempo, beat_times, y, sr = analyze_audio(file)
+    import librosa.display
+    import matplotlib.pyplot as plt
+
+    tempo, beat_times, y, sr = analyze_audio(path, waveform=True)
 
     print(f"Estimated Tempo: {tempo} BPM")
     print("Beat Times:", beat_times)
@@ -0,0 +1,63 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+from numpy._typing import NDArray
+
+
+class StepTimeline:
+    def __init__(self, timestamps: NDArray, poses: NDArray):
+        order = np.argsort(timestamps, kind="stable")
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)[order]
+        self.poses = np.asarray(poses).reshape(-1, 17, 3)[order]
+        self.trajectories: Dict[int, StepTimeline] = dict()
+
+    @classmethod
+    def from_steps(cls, steps: List[Tuple[float, List[Tuple[float, float, float]]]]):
+        timestamps = np.array([step[0] for step in steps], dtype=np.float64)
+        poses = np.array([step[1] for step in steps], dtype=np.float64)
+        return cls(timestamps, poses.reshape(-1, 17, 3))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def find(self, timestamp: float, tolerance: float) -> int | None:
+        i = int(np.searchsorted(self.timestamps, timestamp))
+        if i == len(self.timestamps) or (
+            i > 0
+            and timestamp - self.timestamps[i - 1] < self.timestamps[i] - timestamp
+        ):
+            i -= 1
+
+        if i < 0 or abs(self.timestamps[i] - timestamp) > tolerance:
+            return None
+        return i
+
+    def trajectory(self, subdivisions: int) -> "StepTimeline":
+        # Reference resampled at `subdivisions` points per beat interval,
+        # kept on the timeline so it is cached and invalidated together
+        trajectory = self.trajectories.get(subdivisions)
+        if trajectory is None:
+            trajectory = self.resample(subdivisions)
+            self.trajectories[subdivisions] = trajectory
+        return trajectory
+
+    def resample(self, subdivisions: int) -> "StepTimeline":
+        if len(self) < 2 or subdivisions <= 1:
+            return StepTimeline(self.timestamps, self.poses)
+
+        position = np.arange((len(self) - 1) * subdivisions + 1) / subdivisions
+        lo = np.minimum(position.astype(np.int64), len(self) - 2)
+        hi = lo + 1
+        f = position - lo
+
+        timestamps = self.timestamps[lo] * (1 - f) + self.timestamps[hi] * f
+
+        # Keypoints move linearly while visible on both beats, otherwise the
+        # nearest beat is held since hidden coordinates are meaningless
+        weight = f[:, None, None].astype(self.poses.dtype)
+        poses = self.poses[lo] * (1 - weight) + self.poses[hi] * weight
+        visible = (self.poses[lo, :, 0] >= 0.5) & (self.poses[hi, :, 0] >= 0.5)
+        nearest = np.where((f < 0.5)[:, None, None], self.poses[lo], self.poses[hi])
+        poses = np.where(visible[..., None], poses, nearest)
+
+        return StepTimeline(timestamps, poses)
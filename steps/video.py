@@ -1,19 +1,25 @@
-import json
-from math import sqrt
-from typing import Dict, Generator, List, Tuple
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Dict, Generator, Iterable, List, Tuple
 
 import cv2
 import numpy as np
 from cv2.typing import MatLike
 from numpy._typing import NDArray
-from ultralytics import YOLO
-from ultralytics.engine.model import Results
 
+# torch and ultralytics take seconds to import, they are only loaded by the
+# functions that track or build results
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+    from ultralytics.engine.model import Results
+
+
+def get_frames(path: str, timestamps: NDArray, sequential=True) -> List[MatLike] | None:
+    if sequential:
+        return list(iter_frames(path, timestamps))
 
-def get_frames(path: str, timestamps: NDArray) -> List[MatLike] | None:
     cap = cv2.VideoCapture(path)
 
-    if not cap.isOpened:
+    if not cap.isOpened():
         print("cannot open video file")
         return None
 
@@ -34,10 +40,157 @@ def get_frames(path: str, timestamps: NDArray) -> List[MatLike] | None:
         cap.release()
 
 
-def track_pose(model: YOLO, frames: List[MatLike]) -> Generator[Results, None, None]:
-    for frame in frames:
-        result = model.track(frame, persist=True)
-        yield result[0]
+def resize_frame(frame: MatLike, max_size: int | None) -> MatLike:
+    height, width = frame.shape[:2]
+    if max_size is None or max(height, width) <= max_size:
+        return frame
+
+    scale = max_size / max(height, width)
+    size = (round(width * scale), round(height * scale))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def iter_frames(
+    path: str, timestamps: NDArray, max_size: int | None = None
+) -> Generator[MatLike, None, None]:
+    # Decodes the video once front to back, frames between beats are only
+    # grabbed, never converted, and nothing but the current frame is kept
+    cap = cv2.VideoCapture(path)
+
+    if not cap.isOpened():
+        print("cannot open video file")
+        return
+
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        current = -1
+        frame = None
+
+        for timestamp in timestamps:
+            index = round(timestamp * fps)
+
+            if index < current:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                current = index - 1
+
+            if index != current:
+                while current < index - 1 and cap.grab():
+                    current += 1
+
+                ret, frame = cap.read()
+                if not ret or current != index - 1:
+                    print(f"Error: Could not read frame at index {index}")
+                    return
+
+                frame = resize_frame(frame, max_size)
+                current = index
+
+            yield frame
+    finally:
+        cap.release()
+
+
+def tracker_settings(config: str = "botsort.yaml") -> Dict[str, Any]:
+    from ultralytics.utils import yaml_load
+    from ultralytics.utils.checks import check_yaml
+
+    return yaml_load(check_yaml(config))
+
+
+def create_tracker(config: str = "botsort.yaml"):
+    from ultralytics.trackers.track import TRACKER_MAP
+    from ultralytics.utils import IterableSimpleNamespace
+
+    cfg = IterableSimpleNamespace(**tracker_settings(config))
+    return TRACKER_MAP[cfg.tracker_type](args=cfg, frame_rate=30)
+
+
+def update_tracker(tracker, result: "Results") -> "Results":
+    # Same as ultralytics' track callback, but the tracker is owned by the caller
+    # so one model can serve many independent streams
+    import torch
+
+    det = result.boxes.cpu().numpy()
+    if len(det) == 0:
+        return result
+
+    tracks = tracker.update(det, result.orig_img)
+    if len(tracks) == 0:
+        tracks = np.zeros((0, 8), dtype=np.float32)
+
+    result = result[tracks[:, -1].astype(int)]
+    result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+    return result
+
+
+def shift_result(
+    result: "Results", frame: MatLike, offset: Tuple[int, int]
+) -> "Results":
+    # Maps a result inferred on a crop of `frame` back to frame coordinates
+    from ultralytics.engine.model import Results
+
+    (x, y) = offset
+    boxes = result.boxes.data.clone()
+    boxes[:, [0, 2]] += x
+    boxes[:, [1, 3]] += y
+    keypoints = result.keypoints.data.clone()
+    keypoints[..., 0] += x
+    keypoints[..., 1] += y
+    return Results(
+        frame,
+        result.path,
+        result.names,
+        boxes=boxes,
+        keypoints=keypoints,
+        speed=result.speed,
+    )
+
+
+class RegionOfInterest:
+    # Crops frames to the union of the last tracked boxes plus a margin, with
+    # a full frame every `redetect_interval` frames to find dancers outside it
+    def __init__(self, margin=0.15, redetect_interval=15):
+        self.margin = margin
+        self.redetect_interval = redetect_interval
+        self.box: Tuple[int, int, int, int] | None = None
+        self.age = 0
+
+    def crop(self, frame: MatLike) -> Tuple[MatLike, Tuple[int, int] | None]:
+        if self.box is None or self.age >= self.redetect_interval:
+            self.age = 0
+            return (frame, None)
+
+        self.age += 1
+        (x1, y1, x2, y2) = self.box
+        return (np.ascontiguousarray(frame[y1:y2, x1:x2]), (x1, y1))
+
+    def update(self, boxes: NDArray, width: int, height: int):
+        if len(boxes) == 0:
+            self.box = None
+            return
+
+        (x1, y1) = boxes[:, :2].min(axis=0)
+        (x2, y2) = boxes[:, 2:4].max(axis=0)
+        margin_x = (x2 - x1) * self.margin
+        margin_y = (y2 - y1) * self.margin
+        self.box = (
+            max(int(x1 - margin_x), 0),
+            max(int(y1 - margin_y), 0),
+            min(int(x2 + margin_x) + 1, width),
+            min(int(y2 + margin_y) + 1, height),
+        )
+
+
+def track_pose(
+    model: "YOLO", frames: Iterable[MatLike], tracker=None, batch_size=1
+) -> Generator["Results", None, None]:
+    if tracker is None:
+        tracker = create_tracker()
+
+    frames = iter(frames)
+    while batch := list(islice(frames, batch_size)):
+        for result in model.predict(batch, verbose=False):
+            yield update_tracker(tracker, result)
 
 
 def geom_pose(obj) -> Tuple[float, float, float, float]:
@@ -60,105 +213,152 @@ def normalize_pose(obj) -> List[Tuple[float, float, float]]:
     return list(zip(visible, x, y))
 
 
+def pose_arrays(result: "Results") -> Tuple[NDArray, NDArray, NDArray]:
+    # Track ids (n), normalized xyxy boxes (n x 4) and keypoints (n x 17 x 3)
+    # as (confidence, x, y) normalized like normalize_pose, read from the tensors
+    boxes = result.boxes
+    if boxes.id is None:
+        ids = np.full(len(boxes), -1, dtype=np.int64)
+    else:
+        ids = boxes.id.cpu().numpy().astype(np.int64)
+    xyxyn = boxes.xyxyn.cpu().numpy()
+
+    (height, width) = result.orig_shape
+    keypoints = result.keypoints.data.cpu().numpy()
+    if len(boxes) == 0:
+        # ultralytics keeps a (1, 0, 51) keypoint tensor on empty results
+        keypoints = np.empty((0, 17, 3), dtype=np.float32)
+
+    return (ids, xyxyn, normalize_poses(xyxyn, keypoints, width, height))
+
+
+def normalize_poses(xyxyn: NDArray, keypoints: NDArray, width, height) -> NDArray:
+    mid_x = (xyxyn[:, 0] + xyxyn[:, 2])[:, None] / 2
+    mid_y = (xyxyn[:, 1] + xyxyn[:, 3])[:, None] / 2
+    h = (xyxyn[:, 3] - xyxyn[:, 1])[:, None]
+
+    poses = np.empty(keypoints.shape, dtype=np.float32)
+    poses[..., 0] = keypoints[..., 2]
+    poses[..., 1] = (keypoints[..., 0] / width - mid_x) / h + 0.5
+    poses[..., 2] = (keypoints[..., 1] / height - mid_y) / h + 0.5
+    return poses
+
+
 def get_main_pose(
-    model: YOLO,
-    frames: List[MatLike],
+    model: "YOLO",
+    frames: Iterable[MatLike],
     timestamps: NDArray,
-) -> List[Tuple[float, List[Tuple[float, float, float]]]]:
-    poses = track_pose(model, frames)
-    results = [json.loads(pose.to_json(normalize=True)) for pose in poses]
-
-    trackCenters: Dict[int, Tuple[int, float, float]] = dict()
-    for res in results:
-        for obj in res:
-            id = obj["track_id"]
-            (midX, midY, _, _) = geom_pose(obj)
-            prevCenter = trackCenters.get(id)
-            if prevCenter is None:
-                trackCenters[id] = (1, midX, midY)
-            else:
-                trackCenters[id] = (
-                    prevCenter[0] + 1,
-                    prevCenter[1] + midX,
-                    prevCenter[2] + midY,
-                )
-
-    if len(trackCenters) == 0:
-        return []
-
-    centerTrackId = None
-    bestCenter = 2
-    for k, (count, x, y) in trackCenters.items():
-        dX = (x / count) - 0.5
-        dY = (y / count) - 0.5
-        dist = sqrt(dX * dX + dY * dY)
-        if dist < bestCenter:
-            bestCenter = dist
-            centerTrackId = k
-
-    if centerTrackId is None:
-        return []
-
-    res = []
-
-    for i, timestamp in enumerate(timestamps):
-        for obj in results[i]:
-            if obj["track_id"] == centerTrackId:
-                res.append((timestamp, normalize_pose(obj)))
-                break
+    batch_size=1,
+    tracker=None,
+) -> Tuple[NDArray, NDArray]:
+    results = [
+        pose_arrays(pose) for pose in track_pose(model, frames, tracker, batch_size)
+    ]
+    timestamps = np.asarray(timestamps, dtype=np.float64)[: len(results)]
+
+    if sum(len(ids) for (ids, _, _) in results) == 0:
+        return (np.zeros(0), np.zeros((0, 17, 3), dtype=np.float32))
+
+    ids = np.concatenate([ids for (ids, _, _) in results])
+    boxes = np.concatenate([boxes for (_, boxes, _) in results])
+    centers = np.stack(
+        [(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1
+    )
+
+    # Track ids in order of first appearance, so ties go to the earliest track
+    (unique_ids, first_seen, inverse) = np.unique(
+        ids, return_index=True, return_inverse=True
+    )
+    counts = np.bincount(inverse)
+    mean_centers = np.stack(
+        [np.bincount(inverse, centers[:, i]) / counts for i in range(2)], axis=1
+    )
+    distances = np.sqrt(np.sum((mean_centers - 0.5) ** 2, axis=1))
+
+    order = np.argsort(first_seen, kind="stable")
+    best = order[np.argmin(distances[order])]
+    if distances[best] >= 2:
+        return (np.zeros(0), np.zeros((0, 17, 3), dtype=np.float32))
+    center_track_id = unique_ids[best]
+
+    poses = np.empty((len(results), 17, 3), dtype=np.float32)
+    for i, (frame_ids, _, frame_poses) in enumerate(results):
+        match = np.flatnonzero(frame_ids == center_track_id)
+        if len(match) > 0:
+            poses[i] = frame_poses[match[0]]
+        elif i == 0:
+            poses[i] = (0.0, 0.5, 0.5)
         else:
-            if len(res) == 0:
-                res.append((timestamp, [(0.0, 0.5, 0.5)] * 17))
-            else:
-                res.append((timestamp, res[-1][1]))
-
-    return res
-
-
-def grade_poses(pose_a, pose_b, scaling_factor=1.0):
-    pose_a = np.array(pose_a)
-    pose_b = np.array(pose_b)
-
-    for pose in [pose_a, pose_b]:
-        low_confidence_mask = pose[:, 0] < 0.5
-        pose[low_confidence_mask, 1:] = 0.5
-
-    keypoint_weights = {
-        0: 2,  # nose
-        1: 2,  # left eye
-        2: 2,  # right eye
-        3: 2,  # left ear
-        4: 2,  # right ear
-        5: 12,  # left shoulder
-        6: 12,  # right shoulder
-        7: 8,  # left elbow
-        8: 8,  # right elbow
-        9: 8,  # left wrist
-        10: 8,  # right wrist
-        11: 12,  # left hip
-        12: 12,  # right hip
-        13: 6,  # left knee
-        14: 6,  # right knee
-        15: 4,  # left ankle
-        16: 4,  # right ankle
-    }
-
-    scores = []
-    for i in range(17):
-        weight = keypoint_weights[i]
-
-        if pose_a[i, 0] >= 0.5 or pose_b[i, 0] >= 0.5:
-            distance = np.sqrt(np.sum((pose_a[i, 1:] - pose_b[i, 1:]) ** 2))
-            similarity = np.exp(-distance * 2) * weight
-
-            confidence_factor = (pose_a[i, 0] + pose_b[i, 0]) / 2
-            similarity = similarity * confidence_factor * scaling_factor
-
-            scores.append(similarity)
-        else:
-            scores.append(weight * 0.5 * scaling_factor)
-
-    final_score = sum(scores)
-    final_score = min(max(final_score, 0), 100)
-
-    return round(final_score, 2)
+            poses[i] = poses[i - 1]
+
+    return (timestamps, poses)
+
+
+KEYPOINT_WEIGHTS = np.array(
+    [
+        2,  # nose
+        2,  # left eye
+        2,  # right eye
+        2,  # left ear
+        2,  # right ear
+        12,  # left shoulder
+        12,  # right shoulder
+        8,  # left elbow
+        8,  # right elbow
+        8,  # left wrist
+        8,  # right wrist
+        12,  # left hip
+        12,  # right hip
+        6,  # left knee
+        6,  # right knee
+        4,  # left ankle
+        4,  # right ankle
+    ],
+    dtype=np.float64,
+)
+HIDDEN_KEYPOINT_SCORES = KEYPOINT_WEIGHTS * 0.5
+
+
+def grade_pose_array(poses_a: NDArray, poses_b: NDArray, scaling_factor=1.0) -> NDArray:
+    # Grades broadcastable (..., 17, 3) arrays of (confidence, x, y) keypoints
+    confidence_a = poses_a[..., 0]
+    confidence_b = poses_b[..., 0]
+
+    points_a = np.where((confidence_a < 0.5)[..., None], 0.5, poses_a[..., 1:])
+    points_b = np.where((confidence_b < 0.5)[..., None], 0.5, poses_b[..., 1:])
+    distance = np.sqrt(np.sum((points_a - points_b) ** 2, axis=-1))
+
+    similarity = np.exp(-distance * 2) * KEYPOINT_WEIGHTS
+    confidence_factor = (confidence_a + confidence_b) / 2
+    similarity = similarity * confidence_factor * scaling_factor
+
+    visible = (confidence_a >= 0.5) | (confidence_b >= 0.5)
+    scores = np.where(visible, similarity, HIDDEN_KEYPOINT_SCORES * scaling_factor)
+
+    # cumsum adds in keypoint order, so totals match a plain Python sum exactly
+    final_scores = np.cumsum(scores, axis=-1)[..., -1]
+    return np.round(np.clip(final_scores, 0, 100), 2)
+
+
+def grade_pose_windows(
+    live_timestamps: NDArray,
+    live_poses: NDArray,
+    live_visible: NDArray,
+    reference_timestamps: NDArray,
+    reference_poses: NDArray,
+    window: float,
+) -> Tuple[NDArray, NDArray]:
+    # Matches every live sample (dancers x samples x 17 x 3) with its best
+    # reference sample less than `window` seconds away, and grades each dancer
+    # by its best match. Returns the grades and whether the dancer was visible
+    scores = grade_pose_array(live_poses[:, :, None], reference_poses[None, None])
+    allowed = np.abs(live_timestamps[:, None] - reference_timestamps[None, :]) <= window
+    best = np.where(allowed, scores, 0).max(axis=-1, initial=0)
+    best = np.where(live_visible, best, 0).max(axis=-1, initial=0)
+    return (best, live_visible.any(axis=-1))
+
+
+def grade_poses(pose_a, pose_b, scaling_factor=1.0) -> float:
+    pose_a = np.asarray(pose_a, dtype=np.float64)
+    pose_b = np.asarray(pose_b, dtype=np.float64)
+    return float(grade_pose_array(pose_a, pose_b, scaling_factor))